@@ -0,0 +1,56 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from lectocal import diff
+from lectocal import lesson
+from . import common
+
+
+def _nested_scan_diff(old_schedule, new_schedule):
+    # The nested scans used before the schedules were indexed by id, kept
+    # as a reference point for the scaling of diff_schedules.
+    deletes = [old for old in old_schedule
+               if not any(new.id == old.id for new in new_schedule)]
+    adds = [new for new in new_schedule
+            if not any(old.id == new.id for old in old_schedule)]
+    updates = [new for new in new_schedule for old in old_schedule
+               if new.id == old.id and new != old]
+    return adds, updates, deletes
+
+
+class Diff(object):
+    params = [100, 1000, 10000, 50000]
+    param_names = ["lessons"]
+
+    def setup(self, n_lessons):
+        self.old_schedule = common.make_schedule(n_lessons)
+        self.new_schedule = common.make_changed_schedule(self.old_schedule)
+
+    def time_diff_schedules(self, n_lessons):
+        diff.diff_schedules(self.old_schedule, self.new_schedule)
+
+    def time_schedules_are_identical(self, n_lessons):
+        lesson.schedules_are_identical(self.old_schedule, self.new_schedule)
+
+
+class NestedScanDiff(object):
+    params = [100, 1000, 3000]
+    param_names = ["lessons"]
+
+    def setup(self, n_lessons):
+        self.old_schedule = common.make_schedule(n_lessons)
+        self.new_schedule = common.make_changed_schedule(self.old_schedule)
+
+    def time_nested_scan_diff(self, n_lessons):
+        _nested_scan_diff(self.old_schedule, self.new_schedule)
@@ -0,0 +1,58 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import dateutil.parser
+from lectocal import gcalendar
+from lectocal import lesson
+from . import common
+
+
+def _as_returned_by_google(event):
+    # Google returns times in the calendar's offset, not as sent.
+    for field in ("start", "end"):
+        if "dateTime" in event[field]:
+            event[field]["dateTime"] += "+02:00"
+    return event
+
+
+def _dateutil_parse_event_to_lesson(event):
+    # Decoding with dateutil, as was done before the times were matched
+    # by a regular expression, kept as a reference point.
+    def parse_field(field):
+        if "dateTime" in field:
+            return dateutil.parser.parse(field["dateTime"], ignoretz=True)
+        return dateutil.parser.parse(field["date"], ignoretz=True).date()
+
+    return lesson.Lesson(event["id"],
+                         event["summary"],
+                         gcalendar._get_status_from_color(event["colorId"]),
+                         parse_field(event["start"]),
+                         parse_field(event["end"]),
+                         event["location"],
+                         event["description"],
+                         event["source"].get("url"))
+
+
+class DecodeEvents(object):
+    def setup(self):
+        self.events = [_as_returned_by_google(event) for event in
+                       lesson.schedule_to_events(
+                           common.make_schedule(10000))]
+
+    def time_parse_events_to_schedule(self):
+        gcalendar.parse_events(self.events)
+
+    def time_dateutil_parse_events_to_schedule(self):
+        for event in self.events:
+            _dateutil_parse_event_to_lesson(event)
@@ -0,0 +1,159 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import datetime
+import re
+from lxml import html
+from lectocal import lectio
+from . import common
+from . import fakes
+
+
+def _tree_parse_page_to_lessons(page):
+    # Parsing through a full tree and an XPath query, as was done before
+    # the parser target, kept as a reference point.
+    tree = html.fromstring(page)
+    lesson_elements = tree.xpath("//a[contains(concat("
+                                 "' ', normalize-space(@class), ' '),"
+                                 "' s2skemabrik ')]")
+    return [lectio._parse_element_to_lesson(element)
+            for element in lesson_elements]
+
+
+def _search_get_info_from_title(title):
+    # Tooltip parsing with a separate search for each kind of line, and
+    # strptime for the dates, as was done before the header lines were
+    # classified in one match. Kept as a reference point.
+    def parse_date(value):
+        return datetime.datetime.strptime(value, "%d/%m-%Y").date()
+
+    def parse_time(value):
+        return datetime.datetime.strptime(value, "%H:%M").time()
+
+    summary = description = ""
+    status = start = end = location = None
+    header_section = True
+    for line in title.splitlines():
+        if header_section:
+            if line == "":
+                header_section = False
+            elif re.search("Ændret!|Aflyst!", line):
+                status = lectio.LESSON_STATUS[line]
+            elif re.search(r"\d{1,2}/\d{1,2}-\d{4} (?:Hele dagen|"
+                           r"\d{2}:\d{2} til (?:\d{1,2}/\d{1,2}-\d{4} )?"
+                           r"\d{2}:\d{2})", line):
+                match = re.search(r"(\d{1,2}/\d{1,2}-\d{4})(?: "
+                                  r"(\d{2}:\d{2}) til "
+                                  r"(\d{1,2}/\d{1,2}-\d{4})? ?"
+                                  r"(\d{2}:\d{2}))?", line)
+                start = end = parse_date(match.group(1))
+                if match.group(3):
+                    end = parse_date(match.group(3))
+                if match.group(2):
+                    start = datetime.datetime.combine(
+                        start, parse_time(match.group(2)))
+                    end = datetime.datetime.combine(
+                        end, parse_time(match.group(4)))
+            elif re.search("Lokaler?: ", line):
+                location = re.search("Lokaler?: (.*)", line).group(1)
+            else:
+                if summary != "":
+                    summary += " • "
+                summary += line
+        else:
+            if description != "":
+                description += "\n"
+            description += line
+    return summary, status, start, end, location, description
+
+
+class ParseTooltip(object):
+    def setup(self):
+        self.titles = [common.make_tooltip(i) for i in range(1000)]
+
+    def time_get_info_from_title(self):
+        for title in self.titles:
+            lectio._get_info_from_title(title)
+
+    def time_search_get_info_from_title(self):
+        for title in self.titles:
+            _search_get_info_from_title(title)
+
+
+class ParsePage(object):
+    params = [10, 50, 200]
+    param_names = ["lessons"]
+
+    def setup(self, n_lessons):
+        self.page = common.make_week_page(n_lessons)
+
+    def time_parse_page_to_lessons(self, n_lessons):
+        lectio._parse_page_to_lessons(self.page)
+
+    def time_tree_parse_page_to_lessons(self, n_lessons):
+        _tree_parse_page_to_lessons(self.page)
+
+
+class ParsePagesInPool(object):
+    params = [1, 2, 4]
+    param_names = ["parse_workers"]
+    timeout = 120
+
+    def setup(self, n_workers):
+        self.pages = [common.make_week_page(200, first_id=week * 1000)
+                      for week in range(48)]
+        self.parse_pool = concurrent.futures.ProcessPoolExecutor(n_workers)
+        # Pages are handed to the pool by the threads fetching them.
+        self.fetchers = concurrent.futures.ThreadPoolExecutor(8)
+        # Starts the processes, so starting them isn't timed.
+        list(self.parse_pool.map(int, range(n_workers)))
+
+    def teardown(self, n_workers):
+        self.fetchers.shutdown()
+        self.parse_pool.shutdown()
+
+    def time_parse_pages(self, n_workers):
+        list(self.fetchers.map(self._parse_page, self.pages))
+
+    def _parse_page(self, page):
+        return lectio._parse_page_to_lessons(page, parse_pool=self.parse_pool)
+
+
+class RetrieveSchedule(object):
+    params = [4, 52]
+    param_names = ["weeks"]
+
+    def setup(self, n_weeks):
+        self.session = lectio.create_session()
+        self.session.mount("https://", fakes.FakeLectioAdapter(200))
+        # Every page is generated up front, so only retrieving the
+        # schedule is measured.
+        lectio.get_schedule(1, "student", 1, n_weeks, session=self.session)
+
+    def time_get_schedule(self, n_weeks):
+        lectio.get_schedule(1, "student", 1, n_weeks, session=self.session)
+
+    def time_iter_schedule(self, n_weeks):
+        for lesson in lectio.iter_schedule(1, "student", 1, n_weeks,
+                                           session=self.session):
+            pass
+
+    def peakmem_get_schedule(self, n_weeks):
+        lectio.get_schedule(1, "student", 1, n_weeks, session=self.session)
+
+    def peakmem_iter_schedule(self, n_weeks):
+        for lesson in lectio.iter_schedule(1, "student", 1, n_weeks,
+                                           session=self.session):
+            pass
@@ -0,0 +1,139 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import datetime
+import gc
+import tracemalloc
+from lxml import etree
+from lectocal import lectio
+from lectocal import lesson
+from . import common
+
+WEEKS = 52
+
+
+class _DictLesson(object):
+    # Lessons as they were before __slots__, kept as a reference point.
+    def __init__(self, id, summary, status, start, end, location,
+                 description, link):
+        self.summary = summary
+        self.status = status or "normal"
+        self.start = start
+        self.end = end
+        self.location = location
+        self.description = description
+        self.link = link
+        self.id = id
+
+    def __eq__(self, other):
+        if type(self) == type(other):
+            return self.__dict__ == other.__dict__
+        return False
+
+
+def _deepcopy_to_gcalendar_format(item):
+    # Serialization by copying a template, as was done before the event
+    # body was built directly, kept as a reference point.
+    TEMPLATE = {
+        "summary": None,
+        "id": None,
+        "colorId": None,
+        "start": {
+            "timeZone": "Europe/Copenhagen"
+        },
+        "end": {
+            "timeZone": "Europe/Copenhagen"
+        },
+        "location": None,
+        "description": None,
+        "source": {}
+    }
+
+    formatted = copy.deepcopy(TEMPLATE)
+    formatted["summary"] = item.summary
+    formatted["id"] = item.id
+    formatted["colorId"] = lesson.STATUS_COLORS[item.status]
+    for field, value in (("start", item.start), ("end", item.end)):
+        if type(value) == datetime.datetime:
+            formatted[field]["dateTime"] = value.isoformat()
+        else:
+            formatted[field]["date"] = value.isoformat()
+    formatted["location"] = item.location
+    formatted["description"] = item.description
+    if item.link is not None:
+        formatted["source"]["url"] = item.link
+    return formatted
+
+
+def _get_lesson_elements(n_weeks):
+    page = common.make_week_page(50)
+    parser = etree.HTMLParser(target=lectio._LessonElementTarget())
+    return etree.fromstring(page, parser) * n_weeks
+
+
+def _measure_bytes_per_lesson(lesson_class, elements):
+    # Lessons are parsed from page elements, so the strings and dates they
+    # hold are allocated the same way as in a real sync.
+    original_class = lesson.Lesson
+    lesson.Lesson = lesson_class
+    try:
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        lessons = [lectio._parse_element_to_lesson(element)
+                   for element in elements]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+        lesson.Lesson = original_class
+    return (after - before) / len(lessons)
+
+
+class LessonMemory(object):
+    unit = "bytes"
+
+    def setup(self):
+        self.elements = _get_lesson_elements(WEEKS)
+
+    def track_bytes_per_lesson(self):
+        return _measure_bytes_per_lesson(lesson.Lesson, self.elements)
+
+    def track_bytes_per_dict_lesson(self):
+        return _measure_bytes_per_lesson(_DictLesson, self.elements)
+
+
+class Serialize(object):
+    def setup(self):
+        self.schedule = common.make_schedule(10000)
+
+    def time_schedule_to_events(self):
+        for event in lesson.schedule_to_events(self.schedule):
+            pass
+
+    def time_deepcopy_to_gcalendar_format(self):
+        for item in self.schedule:
+            _deepcopy_to_gcalendar_format(item)
+
+
+class LessonSet(object):
+    def setup(self):
+        self.schedule = common.make_schedule(10000)
+        self.copy = common.make_schedule(10000)
+
+    def time_build_set(self):
+        set(self.schedule)
+
+    def time_schedules_are_identical(self):
+        lesson.schedules_are_identical(self.schedule, self.copy)
@@ -0,0 +1,38 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import sys
+
+# Libraries a sync only needs once it talks to Google, and which are
+# slow to import.
+DEFERRED_MODULES = ("apiclient.discovery", "dateutil.parser", "httplib2",
+                    "oauth2client.client", "pkg_resources")
+
+
+def timeraw_import_run():
+    return "import lectocal.run"
+
+
+def timeraw_import_gcalendar():
+    return "import lectocal.gcalendar"
+
+
+def track_deferred_modules_imported_by_run():
+    code = "import sys, lectocal.run; print(sum(name in sys.modules " \
+           "for name in {!r}))".format(DEFERRED_MODULES)
+    return int(subprocess.check_output([sys.executable, "-c", code]))
+
+
+track_deferred_modules_imported_by_run.unit = "modules"
@@ -0,0 +1,101 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import shutil
+import sys
+import tempfile
+from lectocal import gauth
+from lectocal import lectio
+from lectocal import run
+from . import fakes
+
+WEEKS = 4
+# High enough that the rate limiter never waits, so the sync itself is
+# what gets timed.
+UNLIMITED_QPS = "1000000"
+
+
+class _SyncBenchmark(object):
+    """ Runs run.main against a fake Lectio and fake Calendar API.
+
+    Every user has their own credentials, and with them their own fake
+    calendar, while the Lectio pages are shared.
+    """
+
+    params = [1, 10, 100]
+    param_names = ["users"]
+    number = 1
+    repeat = 3
+    warmup_time = 0
+    timeout = 600
+
+    def setup(self, n_users):
+        self.state_dir = tempfile.mkdtemp()
+        self.calendars = {}
+        self.adapter = fakes.FakeLectioAdapter()
+        self._get_credentials = gauth.get_credentials
+        self._create_session = lectio.create_session
+        self._argv = sys.argv
+        gauth.get_credentials = self._get_fake_credentials
+        lectio.create_session = self._create_fake_session
+        logging.getLogger(run.__name__).setLevel(logging.WARNING)
+
+    def teardown(self, n_users):
+        gauth.get_credentials = self._get_credentials
+        lectio.create_session = self._create_session
+        sys.argv = self._argv
+        logging.getLogger(run.__name__).setLevel(logging.NOTSET)
+        shutil.rmtree(self.state_dir)
+
+    def _get_fake_credentials(self, credentials_path):
+        if credentials_path not in self.calendars:
+            self.calendars[credentials_path] = fakes.FakeCalendarHttp()
+        return fakes.FakeCredentials(self.calendars[credentials_path])
+
+    def _create_fake_session(self, *args, **kwargs):
+        session = self._create_session(*args, **kwargs)
+        session.mount("https://", self.adapter)
+        return session
+
+    def sync_all(self, n_users, *options):
+        for user_id in range(n_users):
+            sys.argv = ["lectocal.run", "1", "student", str(user_id),
+                        "--credentials", "user{}.json".format(user_id),
+                        "--weeks", str(WEEKS),
+                        "--state-dir", self.state_dir,
+                        "--google-qps", UNLIMITED_QPS,
+                        "--google-project-qps", UNLIMITED_QPS] + \
+                list(options)
+            run.main()
+
+
+class FirstSync(_SyncBenchmark):
+    def time_first_sync(self, n_users):
+        self.sync_all(n_users)
+
+
+class Resync(_SyncBenchmark):
+    def setup(self, n_users):
+        super().setup(n_users)
+        self.sync_all(n_users)
+
+    def time_unchanged_resync(self, n_users):
+        self.sync_all(n_users)
+
+    def time_full_resync(self, n_users):
+        self.sync_all(n_users, "--full-sync-interval", "0")
+
+    def time_incremental_full_resync(self, n_users):
+        self.sync_all(n_users, "--full-sync-interval", "0", "--incremental")
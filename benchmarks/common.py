@@ -0,0 +1,123 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import html
+from lectocal import lesson
+
+FIRST_DAY = datetime.date(2018, 8, 6)
+LESSONS_PER_DAY = 6
+
+
+def make_lesson(i, revision=0):
+    day = FIRST_DAY + datetime.timedelta(days=i // LESSONS_PER_DAY)
+    start = datetime.datetime.combine(day, datetime.time(8 + i % 6))
+    end = start + datetime.timedelta(minutes=45)
+    return lesson.Lesson(str(10000000 + i),
+                         "Hold: {}.a Ma • Lærer: Foo Bar (FB)"
+                         .format(i % 3 + 1),
+                         "changed" if revision else None,
+                         start,
+                         end,
+                         "Lokale: {}".format(i % 40),
+                         "Lektier:\n- Side {}".format(i + revision),
+                         "https://www.lectio.dk/lectio/1/aktivitet/"
+                         "aktivitetforside2.aspx?absid={}"
+                         .format(10000000 + i))
+
+
+def make_schedule(n_lessons):
+    return [make_lesson(i) for i in range(n_lessons)]
+
+
+def make_changed_schedule(schedule):
+    """ Copy of schedule with 1% of the lessons removed, changed and added."""
+    n_lessons = len(schedule)
+    step = 100
+    changed = []
+    for i in range(n_lessons):
+        if i % step == 0:
+            continue
+        elif i % step == 1:
+            changed.append(make_lesson(i, revision=1))
+        else:
+            changed.append(schedule[i])
+    changed += [make_lesson(n_lessons + i)
+                for i in range(max(1, n_lessons // step))]
+    return changed
+
+
+def make_tooltip(i, day=FIRST_DAY):
+    lines = []
+    if i % 7 == 0:
+        lines.append("Ændret!")
+    elif i % 11 == 0:
+        lines.append("Aflyst!")
+    if i % 13 == 0:
+        lines.append("{d.day}/{d.month}-{d.year} Hele dagen".format(d=day))
+    else:
+        lines.append("{d.day}/{d.month}-{d.year} {h:02d}:{m:02d} til "
+                     "{h:02d}:{e:02d}".format(d=day, h=8 + i % 8,
+                                              m=(i * 5) % 15,
+                                              e=45 + (i * 5) % 15))
+    lines.append("Hold: {}.a Ma".format(i % 3 + 1))
+    lines.append("Lærer: Foo Bar (FB)")
+    lines.append("Lokale{}: {}".format("r" if i % 4 == 0 else "",
+                                       100 + i % 40))
+    if i % 2 == 0:
+        lines.append("")
+        lines.append("Lektier:")
+        lines.append("- Læs side {} til {} i grundbogen".format(i, i + 10))
+        lines.append("")
+        lines.append("Note:")
+        lines.append("Husk lommeregner & bog")
+    return "\n".join(lines)
+
+
+def make_week_page(n_lessons, first_day=FIRST_DAY, first_id=20000000):
+    """ Page shaped like a SkemaNy.aspx week, holding n_lessons lessons.
+
+    The lessons are spread over the five days from first_day, with ids
+    counting up from first_id. Besides the lessons, the page holds the
+    kind of navigation, scripts and layout tables a real schedule page is
+    padded with.
+    """
+    parts = ["<!DOCTYPE html><html><head><meta charset='utf-8'>"
+             "<title>Skema</title>"]
+    parts += ["<script>var data{0} = [{0}, 'x{0}'];</script>".format(i)
+              for i in range(40)]
+    parts.append("</head><body><div id='s_m_HeaderContent'>")
+    parts += ["<a class='ls-master-header-link' href='/lectio/1/x{0}.aspx'>"
+              "Menu {0}</a>".format(i) for i in range(60)]
+    parts.append("</div><table class='s2skema'><tr>")
+    for i in range(n_lessons):
+        day = first_day + datetime.timedelta(days=i % 5)
+        if i % 5 == 0:
+            parts.append("</tr><tr><td class='s2module-bg'>"
+                         "<div class='s2module-info'>{}. modul</div></td>"
+                         .format(i // 5 + 1))
+        parts.append("<td><div class='s2skemabrikcontainer'>"
+                     "<a class='s2skemabrik s2bgbox s2brik lec-context-menu-"
+                     "instance' href='/lectio/1/aktivitet/aktivitetforside2"
+                     ".aspx?absid={0}&amp;prevurl=SkemaNy.aspx%3ftype%3delev"
+                     "' data-additionalinfo='{1}' style='left:0em;top:{2}em'>"
+                     "<div class='s2skemabrikcontent'><span>{3}.a Ma</span>"
+                     "<span>FB</span><span>{4}</span></div></a></div></td>"
+                     .format(first_id + i, html.escape(make_tooltip(i, day)),
+                             i % 30, i % 3 + 1, 100 + i % 40))
+    parts.append("</tr></table>")
+    parts += ["<div class='footer'><span>Footer {}</span></div>".format(i)
+              for i in range(30)]
+    parts.append("</body></html>")
+    return "".join(parts).encode("utf-8")
@@ -0,0 +1,221 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import email.parser
+import itertools
+import json
+import re
+import urllib.parse
+import httplib2
+import requests
+import requests.adapters
+from . import common
+
+EVENTS_PATH = re.compile(r"/calendar/v3/calendars/([^/]+)/events(?:/([^/]+))?$")
+BATCH_PATH = "/batch/calendar/v3"
+BATCH_BOUNDARY = "fake_batch_boundary"
+LECTIO_WEEK = re.compile(r"week=(\d{2})(\d{4})")
+
+
+def _error(status, reason):
+    return status, {"error": {"code": status,
+                              "errors": [{"reason": reason}]}}
+
+
+def _get_start(event):
+    # Events are stored as lectocal sent them, with naive local times.
+    start = event["start"]
+    return start.get("dateTime") or start["date"]
+
+
+class FakeCalendarHttp(object):
+    """ In-process stand-in for the Calendar v3 endpoints lectocal uses.
+
+    Takes the place of the authorized Http a Calendar service is built
+    with. Handles listing calendars, creating calendars, and listing,
+    inserting, updating and deleting events, singly or in batches, with
+    paging and sync tokens.
+    """
+
+    def __init__(self):
+        self.calendars = {}
+        self.requests = 0
+        self._calendar_ids = itertools.count(1)
+        # Every change to an event is logged, and a sync token is the
+        # length of the log when it was issued.
+        self._changes = []
+
+    def request(self, uri, method="GET", body=None, headers=None,
+                redirections=None, connection_type=None):
+        self.requests += 1
+        url = urllib.parse.urlparse(uri)
+        if url.path == BATCH_PATH:
+            return self._batch(body, headers)
+        status, data = self._handle(method, url.path, url.query, body)
+        return self._response(status, data)
+
+    def _response(self, status, data):
+        content = b"" if data is None else json.dumps(data).encode("utf-8")
+        return httplib2.Response({"status": status,
+                                  "content-type": "application/json"}), \
+            content
+
+    def _handle(self, method, path, query, body):
+        path = urllib.parse.unquote(path)
+        query = {key: values[-1] for key, values
+                 in urllib.parse.parse_qs(query).items()}
+        if path == "/calendar/v3/users/me/calendarList":
+            return 200, {"items": [{"id": calendar_id,
+                                    "summary": calendar["summary"]}
+                                   for calendar_id, calendar
+                                   in self.calendars.items()]}
+        if path == "/calendar/v3/calendars" and method == "POST":
+            calendar_id = "calendar{}@group.calendar.google.com".format(
+                          next(self._calendar_ids))
+            self.calendars[calendar_id] = dict(json.loads(body), events={})
+            return 200, {"id": calendar_id}
+        match = EVENTS_PATH.match(path)
+        if match is None or match.group(1) not in self.calendars:
+            return _error(404, "notFound")
+        calendar_id, event_id = match.groups()
+        events = self.calendars[calendar_id]["events"]
+        if method == "GET" and event_id is None:
+            return self._list(calendar_id, events, query)
+        if method == "POST":
+            event = json.loads(body)
+            if event["id"] in events:
+                return _error(409, "duplicate")
+            return self._write(calendar_id, events, event)
+        if method == "PUT":
+            event = json.loads(body)
+            return self._write(calendar_id, events, event)
+        if method == "DELETE":
+            if event_id not in events or \
+                    events[event_id].get("status") == "cancelled":
+                return _error(410, "deleted")
+            return self._write(calendar_id, events,
+                               {"id": event_id, "status": "cancelled"})
+        return _error(400, "badRequest")
+
+    def _write(self, calendar_id, events, event):
+        events[event["id"]] = event
+        self._changes.append((calendar_id, event["id"]))
+        if event.get("status") == "cancelled":
+            return 204, None
+        return 200, event
+
+    def _list(self, calendar_id, events, query):
+        if "syncToken" in query:
+            changed = {event_id for changed_calendar, event_id
+                       in self._changes[int(query["syncToken"]):]
+                       if changed_calendar == calendar_id}
+            items = [events[event_id] for event_id in sorted(changed)]
+        else:
+            items = [event for event in events.values()
+                     if event.get("status") != "cancelled"]
+            if "timeMin" in query:
+                # Compared as text on the date and time, ignoring offsets.
+                time_min = query["timeMin"][:19]
+                time_max = query["timeMax"][:19]
+                items = [event for event in items
+                         if time_min[:len(_get_start(event))] <=
+                         _get_start(event) <= time_max]
+        offset = int(query.get("pageToken", 0))
+        page_size = int(query.get("maxResults", 250))
+        page = {"items": items[offset:offset + page_size]}
+        if offset + page_size < len(items):
+            page["nextPageToken"] = str(offset + page_size)
+        elif "timeMin" not in query:
+            page["nextSyncToken"] = str(len(self._changes))
+        return 200, page
+
+    def _batch(self, body, headers):
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        message = email.parser.Parser().parsestr(
+            "Content-Type: {}\r\n\r\n{}".format(headers["content-type"],
+                                                body))
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            head, _, request_body = request.partition("\r\n\r\n")
+            if not _:
+                head, _, request_body = request.partition("\n\n")
+            method, uri = head.splitlines()[0].split(" ")[:2]
+            url = urllib.parse.urlparse(uri)
+            status, data = self._handle(method, url.path, url.query,
+                                        request_body or None)
+            parts.append("--{}\r\nContent-Type: application/http\r\n"
+                         "Content-ID: <response-{}>\r\n\r\n"
+                         "HTTP/1.1 {} Fake\r\n"
+                         "Content-Type: application/json\r\n\r\n{}\r\n"
+                         .format(BATCH_BOUNDARY, part["Content-ID"][1:-1],
+                                 status,
+                                 "" if data is None else json.dumps(data)))
+        parts.append("--{}--".format(BATCH_BOUNDARY))
+        return httplib2.Response(
+            {"status": 200,
+             "content-type": "multipart/mixed; boundary={}"
+                             .format(BATCH_BOUNDARY)}), \
+            "".join(parts).encode("utf-8")
+
+
+class FakeCredentials(object):
+    """ Credentials which authorize any Http as a FakeCalendarHttp. """
+
+    def __init__(self, calendar_http):
+        self.calendar_http = calendar_http
+
+    def authorize(self, http):
+        return self.calendar_http
+
+
+def _get_monday(week, year):
+    fourth_of_january = datetime.date(year, 1, 4)
+    return fourth_of_january + datetime.timedelta(
+        days=-fourth_of_january.weekday(), weeks=week - 1)
+
+
+class FakeLectioAdapter(requests.adapters.BaseAdapter):
+    """ Transport adapter answering SkemaNy.aspx requests with week pages.
+
+    Every week holds lessons_per_week lessons, dated in the week asked for,
+    with ids that are unique to the week.
+    """
+
+    def __init__(self, lessons_per_week=30):
+        super().__init__()
+        self.lessons_per_week = lessons_per_week
+        self._pages = {}
+
+    def _get_page(self, week, year):
+        if (week, year) not in self._pages:
+            monday = _get_monday(week, year)
+            self._pages[(week, year)] = common.make_week_page(
+                self.lessons_per_week, monday, monday.toordinal() * 1000)
+        return self._pages[(week, year)]
+
+    def send(self, request, **kwargs):
+        match = LECTIO_WEEK.search(request.url)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.status_code = 200
+        response._content = self._get_page(int(match.group(1)),
+                                           int(match.group(2)))
+        return response
+
+    def close(self):
+        pass
@@ -1 +1 @@
-__all__ = ["gauth", "gcalendar", "lectio", "lesson", "run"]
+__all__ = ["batch", "daemon", "diff", "fingerprint", "gauth", "gcalendar", "lectio", "lesson", "metrics", "pagecache", "plan", "ratelimit", "resources", "run", "schoolstore", "state", "syncstore"]
@@ -0,0 +1,222 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import socket
+import time
+from googleapiclient.errors import HttpError
+from . import metrics
+
+MAX_BATCH_SIZE = 50
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF = 1
+
+INSERT = "insert"
+UPDATE = "update"
+DELETE = "delete"
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+USER_RATE_LIMIT_REASON = "userRateLimitExceeded"
+
+
+class BatchError(Exception):
+    """ Operations in a batch failed, and couldn't be retried.
+
+    failed_operations holds an (operation, error) pair for each of them,
+    and results holds the (operation, response) pairs of the operations
+    which succeeded, as execute would have returned them.
+    """
+
+    def __init__(self, message, failed_operations, results):
+        super().__init__(message)
+        self.failed_operations = failed_operations
+        self.results = results
+
+
+class Operation(object):
+    """ A single insert, update or delete of a lesson in a calendar. """
+
+    def __init__(self, kind, lesson):
+        self.kind = kind
+        self.lesson = lesson
+
+    def to_request(self, events, calendar_id):
+        """ The request for the operation, made from an events resource. """
+        if self.kind == INSERT:
+            return events.insert(calendarId=calendar_id,
+                                 body=self.lesson.to_gcalendar_format())
+        elif self.kind == UPDATE:
+            return events.update(calendarId=calendar_id,
+                                 eventId=self.lesson.id,
+                                 body=self.lesson.to_gcalendar_format())
+        elif self.kind == DELETE:
+            return events.delete(calendarId=calendar_id,
+                                 eventId=self.lesson.id)
+        raise ValueError("Unknown operation: {}".format(self.kind))
+
+    def __repr__(self):
+        return "Operation({}, {})".format(self.kind, self.lesson.id)
+
+
+def _get_error_reasons(err):
+    try:
+        content = json.loads(err.content.decode("utf-8"))
+        return [error.get("reason") for error in content["error"]["errors"]]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return []
+
+
+def _is_rate_limited(err):
+    status = err.resp.status
+    if status == 429:
+        return True
+    return status == 403 and \
+        any(reason in RATE_LIMIT_REASONS for reason in _get_error_reasons(err))
+
+
+def _is_retryable(err):
+    return err.resp.status in RETRY_STATUS_CODES or _is_rate_limited(err)
+
+
+def _get_transport_errors():
+    # httplib2 is only imported once requests are sent, so importing this
+    # module for MAX_BATCH_SIZE doesn't load it.
+    import httplib2
+    return socket.timeout, ConnectionError, httplib2.HttpLib2Error
+
+
+def _adapt_rate(rate_limiter, responses):
+    rate_limited = [err for response, err in responses
+                    if isinstance(err, HttpError) and _is_rate_limited(err)]
+    if not rate_limited:
+        rate_limiter.succeeded()
+        return
+    metrics.increment("google_throttled_batches")
+    user_only = all(USER_RATE_LIMIT_REASON in _get_error_reasons(err)
+                    for err in rate_limited)
+    rate_limiter.throttled(user_only)
+
+
+def _execute_batch(service, calendar_id, operations):
+    responses = {}
+
+    def callback(request_id, response, exception):
+        responses[request_id] = (response, exception)
+
+    batch = service.new_batch_http_request(callback=callback)
+    # Building a resource builds all of its methods, which costs far more
+    # than building a request, so it's done once per batch.
+    events = service.events()
+    for i, operation in enumerate(operations):
+        batch.add(operation.to_request(events, calendar_id),
+                  request_id=str(i))
+    try:
+        batch.execute()
+    except HttpError as err:
+        if not _is_retryable(err):
+            raise err
+        return [(None, err)] * len(operations)
+    except _get_transport_errors() as err:
+        # googleapiclient lets errors of the connection through as they
+        # are. Whether any of the batch was made is unknown, so all of it
+        # is retried, which inserts and deletes already cope with.
+        return [(None, err)] * len(operations)
+    return [responses[str(i)] for i in range(len(operations))]
+
+
+def execute(service, calendar_id, operations,
+            max_attempts=DEFAULT_MAX_ATTEMPTS, backoff=DEFAULT_BACKOFF,
+            rate_limiter=None):
+    """ Execute operations in batches of up to MAX_BATCH_SIZE requests.
+
+    Operations are sent in the order given. Failed operations are retried
+    on their own with exponential backoff, as long as the error is
+    transient, as are all the operations of a batch whose connection
+    failed. An insert of an id which already exists is turned into an
+    update of that id.
+
+    If a rate_limiter is given, every operation takes a token from it, and
+    its rate adapts to the quota errors in each batch.
+
+    Returns a list of (operation, response) pairs for the operations which
+    succeeded. If any of them didn't, or a batch failed for good, BatchError
+    is raised, holding those pairs.
+    """
+    results = []
+    failed = []
+    pending = list(operations)
+    attempt = 1
+    while pending:
+        follow_ups = []
+        retries = []
+        for start in range(0, len(pending), MAX_BATCH_SIZE):
+            chunk = pending[start:start + MAX_BATCH_SIZE]
+            # Google counts each request in a batch against the quota.
+            if rate_limiter is not None:
+                rate_limiter.acquire(len(chunk))
+            try:
+                with metrics.timer("google_batch"):
+                    responses = _execute_batch(service, calendar_id, chunk)
+            except Exception as err:
+                # The operations already made are in the calendar, so they
+                # are handed on with the error, along with all those which
+                # weren't made.
+                unsent = pending[start:] + follow_ups + \
+                    [operation for operation, retry_err in retries]
+                failed += [(operation, err) for operation in unsent]
+                metrics.increment("google_failed_operations", len(failed))
+                raise BatchError("{} of {} operations failed: {}".format(
+                                 len(failed), len(operations), err),
+                                 failed, results) from err
+            if rate_limiter is not None:
+                _adapt_rate(rate_limiter, responses)
+            for operation, (response, err) in zip(chunk, responses):
+                if err is None:
+                    metrics.increment("google_{}s".format(operation.kind))
+                    results.append((operation, response))
+                elif isinstance(err, _get_transport_errors()):
+                    metrics.increment("google_retries")
+                    retries.append((operation, err))
+                elif not isinstance(err, HttpError):
+                    failed.append((operation, err))
+                # Status code 409 is conflict. In this case, it means the id
+                # already exists.
+                elif operation.kind == INSERT and err.resp.status == 409:
+                    follow_ups.append(Operation(UPDATE, operation.lesson))
+                # A delete which is retried after the first attempt made it
+                # through finds the event already gone.
+                elif operation.kind == DELETE and \
+                        err.resp.status in (404, 410):
+                    metrics.increment("google_{}s".format(operation.kind))
+                    results.append((operation, response))
+                elif _is_retryable(err):
+                    metrics.increment("google_retries")
+                    retries.append((operation, err))
+                else:
+                    failed.append((operation, err))
+
+        if retries and attempt >= max_attempts:
+            failed += retries
+            retries = []
+        elif retries:
+            time.sleep(backoff * 2 ** (attempt - 1))
+            attempt += 1
+        pending = follow_ups + [operation for operation, err in retries]
+
+    if failed:
+        metrics.increment("google_failed_operations", len(failed))
+        raise BatchError("{} of {} operations failed".format(
+                         len(failed), len(operations)), failed, results)
+    return results
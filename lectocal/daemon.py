@@ -0,0 +1,271 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import concurrent.futures
+import functools
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+from . import metrics
+from . import run
+from . import schoolstore
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+DEFAULT_INTERVAL = 15 * 60
+DEFAULT_WORKERS = 4
+USER_TYPES = ("student", "teacher")
+
+logger = logging.getLogger(__name__)
+
+
+class RosterError(Exception):
+    """ The roster of users to sync is missing or malformed. """
+
+
+def _read_roster_file(roster_path):
+    with open(roster_path, encoding="utf-8") as f:
+        if os.path.splitext(roster_path)[1] in (".yaml", ".yml"):
+            if yaml is None:
+                raise RosterError("PyYAML must be installed to read the "
+                                  "roster: {}".format(roster_path))
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def _parse_roster_entry(entry, defaults):
+    try:
+        user = argparse.Namespace(school_id=int(entry["school_id"]),
+                                  user_type=entry["user_type"],
+                                  user_id=int(entry["user_id"]),
+                                  credentials=entry.get(
+                                      "credentials", defaults.credentials),
+                                  calendar=entry.get(
+                                      "calendar", defaults.calendar),
+                                  weeks=int(entry.get(
+                                      "weeks", defaults.weeks)),
+                                  teams=entry.get("teams", defaults.teams))
+        if user.teams is not None:
+            user.teams = [int(team_id) for team_id in user.teams]
+    except (KeyError, TypeError, ValueError) as err:
+        raise RosterError("Invalid roster entry: {} ({!r})".format(
+                          entry, err))
+    if user.user_type not in USER_TYPES:
+        raise RosterError("Invalid user type in roster entry: {}"
+                          .format(entry))
+    return user
+
+
+def read_roster(roster_path, defaults):
+    """ Read the users to sync from a JSON or YAML roster.
+
+    The roster holds a list of users under the key "users". Each user must
+    have a school_id, user_type and user_id, and may override the
+    credentials, calendar, weeks and teams given in defaults.
+    """
+    try:
+        roster = _read_roster_file(roster_path)
+        entries = roster["users"]
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        raise RosterError("Couldn't read roster: {} ({!r})".format(
+                          roster_path, err))
+    return [_parse_roster_entry(entry, defaults) for entry in entries]
+
+
+def _describe_user(user):
+    return "{}/{}/{} -> {}".format(user.school_id, user.user_type,
+                                   user.user_id, user.calendar)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.REGISTRY.to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve_metrics(port):
+    """ Serve the metrics for Prometheus at /metrics, in the background. """
+    server = http.server.HTTPServer(("", port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class Daemon(object):
+    """ Syncs a roster of users on an interval, using a pool of workers.
+
+    The Lectio session, page cache, school store, parse pool, sync store
+    and the rate limit of the Google project are shared by all users. Each
+    user keeps their own Calendar client, and with it their own
+    credentials, rate limit and state files.
+    """
+
+    def __init__(self, users, options):
+        self.users = users
+        self.options = options
+        self.lectio_session = run.create_lectio_session(
+            options, pool_size=options.workers * options.lectio_concurrency)
+        self.page_cache = run.create_page_cache(options)
+        self.school_store = schoolstore.SchoolStore(options.lesson_store_size)
+        self.parse_pool = run.create_parse_pool(options)
+        self.sync_store = run.create_sync_store(options)
+        self.project_bucket = run.create_project_bucket(options)
+        self._google_clients = {}
+        self._google_clients_lock = threading.Lock()
+
+    def close(self):
+        """ Stop the parse pool and close the sync store. """
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+        if self.sync_store is not None:
+            self.sync_store.close()
+
+    def _get_google_client_key(self, user):
+        return os.path.abspath(user.credentials), user.calendar
+
+    def _get_google_client(self, user):
+        # Clients are kept between cycles, so each user's Calendar service
+        # is only built once.
+        key = self._get_google_client_key(user)
+        with self._google_clients_lock:
+            if key not in self._google_clients:
+                self._google_clients[key] = run.create_google_client(
+                    user.credentials, self.options, self.project_bucket)
+            return self._google_clients[key]
+
+    def _sync(self, user):
+        changeset = run.sync_user(user, self.options,
+                                  functools.partial(self._get_google_client,
+                                                    user),
+                                  self.lectio_session, self.page_cache,
+                                  self.school_store, self.parse_pool,
+                                  self.sync_store)
+        return changeset, self._pop_transfer_counts(user)
+
+    def _pop_transfer_counts(self, user):
+        # Syncs which didn't need Google don't make a client just for this.
+        with self._google_clients_lock:
+            client = self._google_clients.get(
+                self._get_google_client_key(user))
+        if client is None:
+            return None
+        return client.pop_transfer_counts()
+
+    def run_cycle(self):
+        """ Sync every user once. Failures are logged, not raised. """
+        with metrics.timer("daemon_cycle"):
+            self._run_cycle()
+        if self.options.metrics_out:
+            run.write_metrics(self.options.metrics_out)
+
+    def _run_cycle(self):
+        # Team schedules are shared within a cycle, but fetched anew for
+        # every cycle.
+        self.school_store.new_cycle()
+        with concurrent.futures.ThreadPoolExecutor(
+                self.options.workers) as executor:
+            futures = {executor.submit(self._sync, user): user
+                       for user in self.users}
+            for future in concurrent.futures.as_completed(futures):
+                user = futures[future]
+                try:
+                    changeset, transfer_counts = future.result()
+                except Exception:
+                    metrics.increment("daemon_failed_syncs")
+                    logger.exception("Sync failed for %s",
+                                     _describe_user(user))
+                    continue
+                metrics.increment("daemon_syncs")
+                logger.info("Synced %s: %d added, %d updated, %d deleted; %s",
+                            _describe_user(user), len(changeset.adds),
+                            len(changeset.updates), len(changeset.deletes),
+                            run.describe_transfer(transfer_counts))
+
+    def run_forever(self):
+        while True:
+            started = time.monotonic()
+            self.run_cycle()
+            elapsed = time.monotonic() - started
+            time.sleep(max(0, self.options.interval - elapsed))
+
+
+def _get_arguments():
+    parser = argparse.ArgumentParser(description="Syncs the Lectio "
+                                     "schedules of a roster of users to "
+                                     "Google Calendar, on an interval.")
+    parser.add_argument("roster",
+                        help="JSON or YAML file listing the users to sync.")
+    parser.add_argument("--interval",
+                        type=run.positive_int,
+                        default=DEFAULT_INTERVAL,
+                        help="Seconds between the start of each sync of "
+                        "the roster. (default: {})".format(DEFAULT_INTERVAL))
+    parser.add_argument("--workers",
+                        type=run.positive_int,
+                        default=DEFAULT_WORKERS,
+                        help="Number of users to sync at the same time. "
+                        "(default: {})".format(DEFAULT_WORKERS))
+    parser.add_argument("--once",
+                        action="store_true",
+                        help="Sync the roster once and exit.")
+    parser.add_argument("--metrics-port",
+                        type=run.positive_int,
+                        help="Serve metrics for Prometheus at /metrics on "
+                        "this port.")
+    parser.add_argument("--lesson-store-size",
+                        type=run.positive_int,
+                        default=schoolstore.DEFAULT_MAX_LESSONS,
+                        help="Number of parsed lessons kept to share between "
+                        "users of the same school. (default: {})".format(
+                            schoolstore.DEFAULT_MAX_LESSONS))
+    run.add_user_arguments(parser)
+    run.add_sync_arguments(parser)
+    run.add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    arguments = _get_arguments()
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    daemon = Daemon(read_roster(arguments.roster, arguments), arguments)
+    try:
+        if arguments.metrics_port:
+            serve_metrics(arguments.metrics_port)
+        if arguments.once:
+            daemon.run_cycle()
+        else:
+            daemon.run_forever()
+    finally:
+        daemon.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+
+
+class Changeset(collections.namedtuple("Changeset",
+                                       ["adds", "updates", "deletes"])):
+    """ Lessons to add, update and delete to turn one schedule into another.
+
+    adds and updates hold lessons from the new schedule, deletes holds
+    lessons from the old schedule.
+    """
+
+    __slots__ = ()
+
+    def is_empty(self):
+        return not (self.adds or self.updates or self.deletes)
+
+
+def diff_schedules(old_schedule, new_schedule):
+    """ Compute the changeset from old_schedule to new_schedule.
+
+    Both schedules are indexed by lesson id, so the diff is linear in the
+    size of the schedules. A lesson whose id exists in both schedules is
+    updated if its content differs.
+    """
+    old_lessons = {lesson.id: lesson for lesson in old_schedule}
+    new_ids = set()
+    adds = []
+    updates = []
+    for new_lesson in new_schedule:
+        new_ids.add(new_lesson.id)
+        old_lesson = old_lessons.get(new_lesson.id)
+        if old_lesson is None:
+            adds.append(new_lesson)
+        elif old_lesson != new_lesson:
+            updates.append(new_lesson)
+    deletes = [old_lesson for old_lesson in old_schedule
+               if old_lesson.id not in new_ids]
+    return Changeset(adds, updates, deletes)
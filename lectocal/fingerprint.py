@@ -0,0 +1,80 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import hashlib
+from . import state
+
+# Bumped whenever the way fingerprints are computed changes, so
+# fingerprints stored by an older version are never compared.
+FINGERPRINT_FORMAT = 1
+
+
+def get_week_of_day(day):
+    """ First day of the ISO week day is in. """
+    return day - datetime.timedelta(days=day.weekday())
+
+
+def get_week(lesson):
+    """ First day of the ISO week the lesson starts in. """
+    if isinstance(lesson.start, datetime.datetime):
+        return get_week_of_day(lesson.start.date())
+    return get_week_of_day(lesson.start)
+
+
+def get_weeks(n_weeks):
+    """ First days of this week and the n_weeks weeks following it. """
+    this_week = get_week_of_day(datetime.date.today())
+    return [this_week + datetime.timedelta(weeks=week)
+            for week in range(n_weeks + 1)]
+
+
+def fingerprint_schedule(schedule, weeks):
+    """ Fingerprint of the lessons in each week, keyed by its first day.
+
+    Every week in weeks gets a fingerprint, so a week which has been
+    emptied is told apart from a week which hasn't been seen.
+    """
+    digests = {week: [] for week in weeks}
+    for lesson in schedule:
+        digests.setdefault(get_week(lesson), []).append(lesson.digest)
+    fingerprints = {}
+    for week, week_digests in digests.items():
+        hasher = hashlib.sha256()
+        # Sorted, as the lessons of a week may come in any order.
+        for digest in sorted(week_digests):
+            hasher.update(bytes(digest, "ascii"))
+        fingerprints[week.isoformat()] = hasher.hexdigest()
+    return fingerprints
+
+
+def get_changed_weeks(old_fingerprints, new_fingerprints):
+    """ First days of the weeks whose fingerprint is new or has moved. """
+    return {datetime.datetime.strptime(week, "%Y-%m-%d").date()
+            for week, fingerprint in new_fingerprints.items()
+            if old_fingerprints.get(week) != fingerprint}
+
+
+def load(path):
+    """ Fingerprints last written, and the time of the last full sync. """
+    stored = state.load_json(path, {})
+    if stored.get("format") != FINGERPRINT_FORMAT:
+        return {}, 0
+    return stored["weeks"], stored["reconciled"]
+
+
+def save(path, fingerprints, reconciled):
+    state.save_json(path, {"format": FINGERPRINT_FORMAT,
+                           "weeks": fingerprints,
+                           "reconciled": reconciled})
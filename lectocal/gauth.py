@@ -12,11 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import pkg_resources
 import argparse
 import oauth2client.file
 import oauth2client.client
 import oauth2client.tools
+from . import resources
+
+CLIENT_SECRET = "client_secret.json"
 
 
 class CredentialsMissingError(Exception):
@@ -60,10 +62,6 @@ def _get_arguments():
     return parser.parse_args()
 
 
-def _get_client_secret_path():
-    return pkg_resources.resource_filename(__name__, "client_secret.json")
-
-
 def generate_credentials(client_secret, credentials_storage, scopes, flags):
     store = oauth2client.file.Storage(credentials_storage)
     flow = oauth2client.client.flow_from_clientsecrets(client_secret, scopes)
@@ -72,10 +70,11 @@ def generate_credentials(client_secret, credentials_storage, scopes, flags):
 
 def main():
     arguments = _get_arguments()
-    generate_credentials(_get_client_secret_path(),
-                         arguments.credentials,
-                         arguments.scopes,
-                         arguments)
+    with resources.path(CLIENT_SECRET) as client_secret_path:
+        generate_credentials(client_secret_path,
+                             arguments.credentials,
+                             arguments.scopes,
+                             arguments)
 
 if __name__ == '__main__':
     main()
@@ -13,74 +13,250 @@
 # limitations under the License.
 
 import datetime
+import re
+import threading
+import time
 from httplib2 import Http
 import dateutil.parser
 import apiclient.discovery
+import googleapiclient.http
 import pytz
 from googleapiclient.errors import HttpError
+from . import batch
+from . import fingerprint
 from . import lesson
-
-SERVICE_NAME = "calendar"
-SERVICE_VERSION = "v3"
+from . import metrics
+from . import resources
+from . import state
+
+DISCOVERY_DOCUMENT = "calendar_discovery.json"
+DEFAULT_ID_CACHE_TTL = state.DEFAULT_ID_CACHE_TTL
+# Google only compresses responses for user agents that mention gzip.
+# googleapiclient adds this to single requests, but not to batches.
+USER_AGENT = "lectocal (gzip)"
+# The largest page sizes the Calendar API accepts.
+EVENT_PAGE_SIZE = 2500
+CALENDAR_PAGE_SIZE = 250
+CALENDAR_LIST_FIELDS = "nextPageToken,items(id,summary)"
+# Reads are retried by googleapiclient, with exponential backoff, on
+# server and quota errors.
+READ_RETRIES = 4
+MIRRORED_EVENT_FIELDS = ("id", "summary", "colorId", "start", "end",
+                         "location", "description", "source")
+# Partial responses, holding only the fields needed to parse the events.
+# The sync token must be listed, as fields not listed are left out.
+EVENT_LIST_FIELDS = "nextPageToken,items({})".format(
+                    ",".join(MIRRORED_EVENT_FIELDS))
+EVENT_SYNC_FIELDS = "nextPageToken,nextSyncToken,items(status,{})".format(
+                    ",".join(MIRRORED_EVENT_FIELDS))
+
+# Google formats times as RFC 3339, e.g. 2016-03-14T15:20:00+01:00
+_RFC3339_DATETIME = re.compile(r"(\d{4})-(\d{2})-(\d{2})"
+                               r"T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6})\d*)?"
+                               r"(?:Z|[+-]\d{2}:\d{2})?$")
+_RFC3339_DATE = re.compile(r"(\d{4})-(\d{2})-(\d{2})$")
+
+# Bumped whenever the parameters of the synced listing change, as a sync
+# token is only valid for the parameters it was issued with.
+SYNC_STATE_FORMAT = 2
 
 DEFAULT_TIME_ZONE = pytz.timezone("Europe/Copenhagen")
 LESSON_STATUS = {"10": "normal", "5": "changed", "11": "cancelled"}
+# Guards the id cache files, which clients with the same credentials share.
+_id_cache_lock = threading.Lock()
 
 
 class InvalidStatusError(Exception):
     """ Lesson status can only take the values 10, 5 and 11 """
 
 
-class CalendarNotFoundError(object):
+class CalendarNotFoundError(Exception):
     """ To get the id of a calendar, the calendar must exist. """
 
 
-def _get_calendar_service(google_credentials):
-    return apiclient.discovery.build(SERVICE_NAME, SERVICE_VERSION,
-                                     http=google_credentials.authorize(Http()))
+_discovery_document = None
+
+
+def _get_discovery_document():
+    # The discovery document is shipped with the package, so building the
+    # service doesn't need a round-trip to Google first.
+    global _discovery_document
+    if _discovery_document is None:
+        _discovery_document = resources.read_text(DISCOVERY_DOCUMENT)
+    return _discovery_document
+
+
+def _build_service(http):
+    return apiclient.discovery.build_from_document(_get_discovery_document(),
+                                                   http=http)
+
+
+class _CountingHttp(Http):
+    """ Http which counts the requests made and the bytes transferred.
+
+    httplib2 decompresses responses before handing them on, so their size
+    on the wire isn't known. bytes_received_decompressed counts them as
+    decompressed, and compressed_responses tells how many of them were
+    gzipped on the wire.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received_decompressed = 0
+        self.compressed_responses = 0
+
+    def get_counts(self):
+        return {"requests": self.requests,
+                "bytes_sent": self.bytes_sent,
+                "bytes_received_decompressed":
+                    self.bytes_received_decompressed,
+                "compressed_responses": self.compressed_responses}
+
+    def request(self, uri, method="GET", body=None, headers=None,
+                *args, **kwargs):
+        response, content = super().request(uri, method, body, headers,
+                                             *args, **kwargs)
+        self.requests += 1
+        metrics.increment("google_requests")
+        if body is not None:
+            self.bytes_sent += len(body)
+            metrics.increment("google_bytes_sent", len(body))
+        self.bytes_received_decompressed += len(content)
+        metrics.increment("google_bytes_received_decompressed", len(content))
+        if "-content-encoding" in response:
+            self.compressed_responses += 1
+        return response, content
+
 
+def _execute(client, request, num_retries=READ_RETRIES):
+    if client.rate_limiter is not None:
+        client.rate_limiter.acquire()
+    return request.execute(num_retries=num_retries)
 
-def has_calendar(google_credentials, calendar_name):
-    service = _get_calendar_service(google_credentials)
+
+def _list_all(client, collection, fields, page_size, **parameters):
+    """ Generate every page of a list call on collection.
+
+    fields is the partial response mask, and must include nextPageToken
+    for the pages after the first to be found.
+    """
     page_token = None
     while True:
-        calendar_list = service \
-                        .calendarList() \
-                        .list(pageToken=page_token) \
-                        .execute()
-        for calendar_entry in calendar_list['items']:
-            if calendar_entry["summary"] == calendar_name:
-                return True
-        page_token = calendar_list.get('nextPageToken')
+        page = _execute(client, collection.list(pageToken=page_token,
+                                                maxResults=page_size,
+                                                fields=fields,
+                                                **parameters))
+        yield page
+        page_token = page.get("nextPageToken")
         if not page_token:
-            return False
+            break
 
 
-def create_calendar(google_credentials, calendar_name):
+class CalendarClient(object):
+    """ Calendar service and calendar ids shared between calls.
+
+    The service is built once. Calendar ids are looked up by name once and
+    then cached, on disk as well if id_cache_path is given. Cached ids
+    older than id_cache_ttl seconds are looked up again. If rate_limiter is
+    given, every request to Google is paced by it.
+    """
+
+    def __init__(self, google_credentials, id_cache_path=None,
+                 id_cache_ttl=DEFAULT_ID_CACHE_TTL, rate_limiter=None):
+        self.rate_limiter = rate_limiter
+        self._http = _CountingHttp()
+        googleapiclient.http.set_user_agent(self._http, USER_AGENT)
+        self.service = _build_service(google_credentials.authorize(
+            self._http))
+        self._id_cache_path = id_cache_path
+        self._id_cache_ttl = id_cache_ttl
+        self._calendar_ids = self._load_id_cache()
+
+    def _load_id_cache(self):
+        if self._id_cache_path is None:
+            return {}
+        now = time.time()
+        entries = state.load_json(self._id_cache_path, {})
+        return {name: entry for name, entry in entries.items()
+                if now - entry["resolved"] < self._id_cache_ttl}
+
+    def _save_id_cache(self, calendar_name):
+        if self._id_cache_path is None:
+            return
+        # Other clients may share the file, so only the entry for
+        # calendar_name is written over the entries already in it.
+        with _id_cache_lock:
+            entries = state.load_json(self._id_cache_path, {})
+            if calendar_name in self._calendar_ids:
+                entries[calendar_name] = self._calendar_ids[calendar_name]
+            else:
+                entries.pop(calendar_name, None)
+            state.save_json(self._id_cache_path, entries)
+
+    def _find_calendar_id(self, calendar_name):
+        for calendar_list in _list_all(self,
+                                       self.service.calendarList(),
+                                       CALENDAR_LIST_FIELDS,
+                                       CALENDAR_PAGE_SIZE):
+            for calendar_entry in calendar_list['items']:
+                if calendar_entry["summary"] == calendar_name:
+                    return calendar_entry["id"]
+        return None
+
+    def pop_transfer_counts(self):
+        """ Requests and bytes sent to Google since the last call. """
+        counts = self._http.get_counts()
+        self._http.reset_counts()
+        return counts
+
+    def remember_calendar_id(self, calendar_name, calendar_id):
+        self._calendar_ids[calendar_name] = {"id": calendar_id,
+                                             "resolved": time.time()}
+        self._save_id_cache(calendar_name)
+
+    def forget_calendar_id(self, calendar_name):
+        if self._calendar_ids.pop(calendar_name, None) is not None:
+            self._save_id_cache(calendar_name)
+
+    def get_calendar_id(self, calendar_name):
+        """ Id of the calendar called calendar_name, or None if missing. """
+        if calendar_name in self._calendar_ids:
+            return self._calendar_ids[calendar_name]["id"]
+        calendar_id = self._find_calendar_id(calendar_name)
+        if calendar_id is not None:
+            self.remember_calendar_id(calendar_name, calendar_id)
+        return calendar_id
+
+
+def has_calendar(client, calendar_name):
+    return client.get_calendar_id(calendar_name) is not None
+
+
+def create_calendar(client, calendar_name):
     calendar = {
         "summary": calendar_name,
         "timeZone": DEFAULT_TIME_ZONE.zone
     }
 
-    service = _get_calendar_service(google_credentials)
-    service.calendars().insert(body=calendar).execute()
+    # Inserts aren't idempotent. An insert which failed after Google had
+    # made the calendar would make a second one if retried, so it isn't.
+    created = _execute(client,
+                       client.service.calendars().insert(body=calendar),
+                       num_retries=0)
+    client.remember_calendar_id(calendar_name, created["id"])
 
 
-def _get_calendar_id_for_name(google_credentials, calendar_name):
-    service = _get_calendar_service(google_credentials)
-    page_token = None
-    while True:
-        calendar_list = service \
-                        .calendarList() \
-                        .list(pageToken=page_token) \
-                        .execute()
-        for calendar_entry in calendar_list['items']:
-            if calendar_entry["summary"] == calendar_name:
-                return calendar_entry["id"]
-        page_token = calendar_list.get('nextPageToken')
-        if not page_token:
-            raise CalendarNotFoundError("Calendar: {} not found"
-                                        .format(calendar_name))
+def _get_calendar_id_for_name(client, calendar_name):
+    calendar_id = client.get_calendar_id(calendar_name)
+    if calendar_id is None:
+        raise CalendarNotFoundError("Calendar: {} not found"
+                                    .format(calendar_name))
+    return calendar_id
 
 
 def _get_first_time_of_week():
@@ -97,22 +273,77 @@ def _get_last_time_in_n_weeks(n):
     return datetime.datetime.combine(last_day_n_weeks, datetime.time.max)
 
 
-def _get_events_in_date_range(service, calendar_id, start, end):
-    all_events = []
-    page_token = None
-    while True:
-        events = service \
-                 .events() \
-                 .list(calendarId=calendar_id,
-                       pageToken=page_token,
-                       timeMax=DEFAULT_TIME_ZONE.localize(end).isoformat(),
-                       timeMin=DEFAULT_TIME_ZONE.localize(start).isoformat()) \
-                 .execute()
-        all_events += events["items"]
-        page_token = events.get('nextPageToken')
-        if not page_token:
-            break
-    return all_events
+def _get_events_in_date_range(client, calendar_id, start, end):
+    # Events are generated page by page, so they are never all held in
+    # memory alongside the lessons parsed from them.
+    time_min = DEFAULT_TIME_ZONE.localize(start).isoformat()
+    time_max = DEFAULT_TIME_ZONE.localize(end).isoformat()
+    for events in _list_all(client,
+                            client.service.events(),
+                            EVENT_LIST_FIELDS,
+                            EVENT_PAGE_SIZE,
+                            calendarId=calendar_id,
+                            singleEvents=True,
+                            timeMax=time_max,
+                            timeMin=time_min):
+        yield from events["items"]
+
+
+def _mirror_event(event):
+    return {field: event[field] for field in MIRRORED_EVENT_FIELDS
+            if field in event}
+
+
+def _apply_event_changes(client, calendar_id, events, sync_token):
+    # Without a sync token this is a full sync, which lists every event in
+    # the calendar. Either way the listing ends with a new sync token.
+    # Recurring events are listed as their instances, like the lessons.
+    for response in _list_all(client,
+                              client.service.events(),
+                              EVENT_SYNC_FIELDS,
+                              EVENT_PAGE_SIZE,
+                              calendarId=calendar_id,
+                              singleEvents=True,
+                              syncToken=sync_token):
+        for event in response["items"]:
+            if event.get("status") == "cancelled":
+                events.pop(event["id"], None)
+            else:
+                events[event["id"]] = _mirror_event(event)
+    return response["nextSyncToken"]
+
+
+def _get_synced_events(client, calendar_id, sync_state_path):
+    sync_state = state.load_json(sync_state_path, {})
+    if sync_state.get("calendar_id") == calendar_id and \
+       sync_state.get("format") == SYNC_STATE_FORMAT:
+        events = sync_state["events"]
+        sync_token = sync_state["sync_token"]
+    else:
+        events = {}
+        sync_token = None
+    try:
+        sync_token = _apply_event_changes(client, calendar_id, events,
+                                          sync_token)
+    except HttpError as err:
+        # Status code 410 is gone. The sync token has expired, and the
+        # mirror must be rebuilt with a full sync.
+        if err.resp.status != 410 or sync_token is None:
+            raise err
+        events = {}
+        sync_token = _apply_event_changes(client, calendar_id, events, None)
+    state.save_json(sync_state_path, {"format": SYNC_STATE_FORMAT,
+                                      "calendar_id": calendar_id,
+                                      "sync_token": sync_token,
+                                      "events": events})
+    return list(events.values())
+
+
+def _is_in_range(lesson, start, end):
+    # Matches the overlap check done by timeMin and timeMax when listing.
+    if isinstance(lesson.start, datetime.datetime):
+        return lesson.end > start and lesson.start < end
+    return lesson.end >= start.date() and lesson.start <= end.date()
 
 
 def _get_status_from_color(colorId):
@@ -124,11 +355,24 @@ def _get_status_from_color(colorId):
 
 
 def _get_datetime_from_field(field):
-    return dateutil.parser.parse(field, ignoretz=True)
+    match = _RFC3339_DATETIME.match(field)
+    if match is None:
+        return dateutil.parser.parse(field, ignoretz=True)
+    year, month, day, hour, minute, second, fraction = match.groups()
+    if fraction:
+        microsecond = int(fraction.ljust(6, "0"))
+    else:
+        microsecond = 0
+    return datetime.datetime(int(year), int(month), int(day), int(hour),
+                             int(minute), int(second), microsecond)
 
 
 def _get_date_from_field(field):
-    return dateutil.parser.parse(field, ignoretz=True).date()
+    match = _RFC3339_DATE.match(field)
+    if match is None:
+        return dateutil.parser.parse(field, ignoretz=True).date()
+    year, month, day = match.groups()
+    return datetime.date(int(year), int(month), int(day))
 
 
 def _parse_event_to_lesson(event):
@@ -158,80 +402,80 @@ def _parse_event_to_lesson(event):
     return lesson.Lesson(id, summary, status, start, end, location, description, link)
 
 
-def _parse_events_to_schedule(events):
-    schedule = []
-    for event in events:
-        schedule.append(_parse_event_to_lesson(event))
-    return schedule
-
-
-def get_schedule(google_credentials, calendar_name, n_weeks):
-    service = _get_calendar_service(google_credentials)
-    calendar_id = _get_calendar_id_for_name(google_credentials, calendar_name)
-    start = _get_first_time_of_week()
-    end = _get_last_time_in_n_weeks(n_weeks)
-    events = _get_events_in_date_range(service, calendar_id, start, end)
-    return _parse_events_to_schedule(events)
-
+def parse_events(events):
+    """ The lessons of Google Calendar events, as read from Google. """
+    return [_parse_event_to_lesson(event) for event in events]
 
-def _delete_lesson(service, calendar_id, lesson_id):
-    service \
-        .events() \
-        .delete(calendarId=calendar_id, eventId=lesson_id) \
-        .execute()
 
+def get_schedule(client, calendar_name, n_weeks, sync_state_path=None,
+                 weeks=None):
+    """ Get the lessons in the calendar for the coming n_weeks.
 
-def _add_lesson(service, calendar_id, lesson):
+    If sync_state_path is given, a mirror of the calendar is kept in that
+    file, and only the changes since the last call are downloaded.
+    If weeks is given, as the first days of ISO weeks, only the lessons
+    starting in those weeks are fetched.
+    """
+    calendar_id = _get_calendar_id_for_name(client, calendar_name)
+    if weeks:
+        start = datetime.datetime.combine(min(weeks), datetime.time.min)
+        end = datetime.datetime.combine(max(weeks) +
+                                        datetime.timedelta(days=6),
+                                        datetime.time.max)
+    else:
+        start = _get_first_time_of_week()
+        end = _get_last_time_in_n_weeks(n_weeks)
     try:
-        service \
-            .events() \
-            .insert(calendarId=calendar_id, body=lesson.to_gcalendar_format()) \
-            .execute()
+        # Events are parsed as they are listed, so both are timed together.
+        with metrics.timer("google_events_fetch"):
+            if sync_state_path is None:
+                events = _get_events_in_date_range(client, calendar_id,
+                                                   start, end)
+                schedule = parse_events(events)
+            else:
+                events = _get_synced_events(client, calendar_id,
+                                            sync_state_path)
+                schedule = [lesson for lesson
+                            in parse_events(events)
+                            if _is_in_range(lesson, start, end)]
     except HttpError as err:
-        #Status code 409 is conflict. In this case, it means the id already exists.
-        if err.resp.status == 409:
-            _update_lesson(service, calendar_id, lesson)
-        else:
-            raise err
-
-
-def _update_lesson(service, calendar_id, lesson):
-    service \
-        .events() \
-        .update(calendarId=calendar_id,
-                eventId=lesson.id,
-                body=lesson.to_gcalendar_format()) \
-        .execute()
-
-
-def _delete_removed_lessons(service, calendar_id, old_schedule, new_schedule):
-    for old_lesson in old_schedule:
-        if not any(new_lesson.id == old_lesson.id
-                   for new_lesson in new_schedule):
-            _delete_lesson(service, calendar_id, old_lesson.id)
-
-
-def _add_new_lessons(service, calendar_id, old_schedule, new_schedule):
-    for new_lesson in new_schedule:
-        if not any(old_lesson.id == new_lesson.id
-                   for old_lesson in old_schedule):
-            _add_lesson(service, calendar_id, new_lesson)
-
-
-def _update_current_lessons(service, calendar_id, old_schedule, new_schedule):
-    for new_lesson in new_schedule:
-        for old_lesson in old_schedule:
-            if new_lesson.id == old_lesson.id:
-                if new_lesson != old_lesson:
-                    _update_lesson(service, calendar_id, new_lesson)
+        # The calendar was deleted since its id was cached.
+        if err.resp.status == 404:
+            client.forget_calendar_id(calendar_name)
+            raise CalendarNotFoundError("Calendar: {} not found"
+                                        .format(calendar_name))
+        raise err
+    if weeks:
+        # The range spans the weeks in between as well.
+        schedule = [lesson for lesson in schedule
+                    if fingerprint.get_week(lesson) in weeks]
+    return schedule
 
 
-def update_calendar_with_schedule(google_credentials,
-                                  calendar_name,
-                                  old_schedule,
-                                  new_schedule):
-    service = _get_calendar_service(google_credentials)
-    calendar_id = _get_calendar_id_for_name(google_credentials, calendar_name)
-    _delete_removed_lessons(service, calendar_id, old_schedule, new_schedule)
-    _add_new_lessons(service, calendar_id, old_schedule, new_schedule)
-    _update_current_lessons(service, calendar_id, old_schedule, new_schedule)
+def _get_priority(operation):
+    # The weeks are written in order, so the weeks nearest in time are
+    # written before the quota runs out, and the deletes of a week come
+    # before its inserts and updates. Past weeks, if any, come first.
+    return (fingerprint.get_week(operation.lesson),
+            operation.kind != batch.DELETE)
+
+
+def _get_operations(changeset):
+    operations = [batch.Operation(batch.DELETE, lesson)
+                  for lesson in changeset.deletes] + \
+                 [batch.Operation(batch.INSERT, lesson)
+                  for lesson in changeset.adds] + \
+                 [batch.Operation(batch.UPDATE, lesson)
+                  for lesson in changeset.updates]
+    operations.sort(key=_get_priority)
+    return operations
+
+
+def update_calendar_with_schedule(client, calendar_name, changeset):
+    """ Write changeset to the calendar, and return the results of the
+    operations, as returned by batch.execute.
+    """
+    calendar_id = _get_calendar_id_for_name(client, calendar_name)
+    return batch.execute(client.service, calendar_id,
+                         _get_operations(changeset),
+                         rate_limiter=client.rate_limiter)
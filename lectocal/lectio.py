@@ -12,16 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import concurrent.futures
 import datetime
+import functools
+import hashlib
+import itertools
 import re
 import requests
-from lxml import html
+import requests.adapters
+from urllib3.util.retry import Retry
+from lxml import etree
+from . import fingerprint
 from . import lesson
+from . import metrics
 
 
-USER_TYPE = {"student": "elev", "teacher": "laerer"}
+USER_TYPE = {"student": "elev", "teacher": "laerer", "team": "holdelement"}
 LESSON_STATUS = {None: "normal", "Ændret!": "changed", "Aflyst!": "cancelled"}
 
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+LESSON_CLASS = "s2skemabrik"
+
 
 class UserDoesNotExistError(Exception):
     """ Attempted to get a non-existing user from Lectio. """
@@ -43,15 +58,69 @@ class InvalidLocationError(Exception):
     """ The line doesn't include any location. """
 
 
-def _get_user_page(school_id, user_type, user_id, week=""):
+class ScheduleRetrievalError(Exception):
+    """ One or more weeks of the schedule couldn't be retrieved.
+
+    The lessons from the weeks that were retrieved are kept in schedule,
+    and the error raised for each failed week is kept in failed_weeks.
+    """
+
+    def __init__(self, message, schedule, failed_weeks):
+        super().__init__(message)
+        self.schedule = schedule
+        self.failed_weeks = failed_weeks
+
+
+class _TimeoutSession(requests.Session):
+    """ Session applying a default timeout to every request. """
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def create_session(timeout=DEFAULT_TIMEOUT,
+                   retries=DEFAULT_RETRIES,
+                   backoff_factor=DEFAULT_BACKOFF_FACTOR,
+                   pool_size=requests.adapters.DEFAULT_POOLSIZE):
+    """ Create a pooled keep-alive session for talking to Lectio.
+
+    Connection errors, resets and 5xx responses are retried with
+    exponential backoff. pool_size should be at least the number of
+    threads sharing the session.
+    """
+    retry = Retry(total=retries,
+                  connect=retries,
+                  read=retries,
+                  status=retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUS_CODES)
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size,
+                                            max_retries=retry)
+    session = _TimeoutSession(timeout)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@metrics.timed("lectio_page_fetch")
+def _get_user_page(session, school_id, user_type, user_id, week="",
+                   headers=None):
     URL_TEMPLATE = "https://www.lectio.dk/lectio/{0}/" \
                    "SkemaNy.aspx?type={1}&{1}id={2}&week={3}"
 
-    r = requests.get(URL_TEMPLATE.format(school_id,
-                                         USER_TYPE[user_type],
-                                         user_id,
-                                         week),
-                     allow_redirects=False)
+    r = session.get(URL_TEMPLATE.format(school_id,
+                                        USER_TYPE[user_type],
+                                        user_id,
+                                        week),
+                    headers=headers,
+                    allow_redirects=False)
+    metrics.increment("lectio_requests")
+    metrics.increment("lectio_bytes_downloaded", len(r.content))
     return r
 
 
@@ -64,8 +133,40 @@ def _get_lectio_weekformat_with_offset(offset):
     return lectio_week
 
 
+_ID_IN_LINK = re.compile(r"(?:absid|ProeveholdId|outboundCensorID)=(\d+)")
+_DATE = re.compile(r"\d{1,2}/\d{1,2}-\d{4}")
+# Each header line of a lesson's info is classified with one match. The
+# alternatives are tried in order, so a line holding more than one kind of
+# information is classified by the first one: status, then time, then
+# location. Lines matching none of them are part of the summary.
+#
+# The time is found in one of the following formats:
+# 14/3-2016 Hele dagen
+# 14/3-2016 15:20 til 16:50
+# 8/4-2016 17:30 til 9/4-2016 01:00
+# 7/12-2015 10:00 til 11:30
+# 17/12-2015 10:00 til 11:30
+_HEADER_LINE = re.compile(
+    r"(?=.*?(?P<status>Ændret!|Aflyst!))"
+    r"|(?=.*?(?P<start_day>\d{1,2})/(?P<start_month>\d{1,2})-"
+    r"(?P<start_year>\d{4}) (?:Hele dagen|"
+    r"(?P<start_hour>\d{2}):(?P<start_minute>\d{2}) til "
+    r"(?:(?P<end_day>\d{1,2})/(?P<end_month>\d{1,2})-(?P<end_year>\d{4}) )?"
+    r"(?P<end_hour>\d{2}):(?P<end_minute>\d{2})))"
+    r"|(?=.*?Lokaler?: (?P<location>.*))")
+# Extracts the following information in capture groups:
+# 1, 2, 3 - start day, month and year
+# 4, 5 - start hour and minute
+# 6, 7, 8 - end day, month and year
+# 9, 10 - end hour and minute
+_TIME_FIELDS = re.compile(r"(\d{1,2})/(\d{1,2})-(\d{4})"
+                          r"(?: (\d{2}):(\d{2}) til "
+                          r"(?:(\d{1,2})/(\d{1,2})-(\d{4}))? ?"
+                          r"(\d{2}):(\d{2}))?")
+
+
 def _get_id_from_link(link):
-    match = re.search("(?:absid|ProeveholdId|outboundCensorID)=(\d+)", link)
+    match = _ID_IN_LINK.search(link)
     if match is None:
         raise IdNotFoundInLinkError("Couldn't find id in link: {}".format(
                                     link))
@@ -75,28 +176,6 @@ def _get_complete_link(link):
     return "https://www.lectio.dk" + link.split("&prevurl=", 1)[0]
 
 
-def _is_status_line(line):
-    match = re.search("Ændret!|Aflyst!", line)
-    return match is not None
-
-
-def _is_location_line(line):
-    match = re.search("Lokaler?: ", line)
-    return match is not None
-
-
-def _is_time_line(line):
-    # Search for one of the following formats:
-    # 14/3-2016 Hele dagen
-    # 14/3-2016 15:20 til 16:50
-    # 8/4-2016 17:30 til 9/4-2016 01:00
-    # 7/12-2015 10:00 til 11:30
-    # 17/12-2015 10:00 til 11:30
-    match = re.search("\d{1,2}/\d{1,2}-\d{4} (?:Hele dagen|\d{2}:\d{2} til "
-                      "(?:\d{1,2}/\d{1,2}-\d{4} )?\d{2}:\d{2})", line)
-    return match is not None
-
-
 def _get_status_from_line(line):
     try:
         return LESSON_STATUS[line]
@@ -104,98 +183,91 @@ def _get_status_from_line(line):
         raise InvalidStatusError("Line: '{}' has no valid status".format(line))
 
 
-def _get_location_from_line(line):
-    match = re.search("Lokaler?: (.*)", line)
-    if match is None:
-        raise InvalidLocationError("No location found in line: '{}'"
-                                   .format(line))
-    return match.group(1)
-
+def _get_time_from_fields(start_day, start_month, start_year,
+                          start_hour, start_minute,
+                          end_day, end_month, end_year,
+                          end_hour, end_minute):
+    if end_day is None:
+        end_day, end_month, end_year = start_day, start_month, start_year
 
-def _get_date_from_match(match):
-    if match:
-        return datetime.datetime.strptime(match, "%d/%m-%Y").date()
+    if start_hour is None:
+        start = datetime.date(int(start_year), int(start_month),
+                              int(start_day))
     else:
-        return None
+        start = datetime.datetime(int(start_year), int(start_month),
+                                  int(start_day), int(start_hour),
+                                  int(start_minute))
 
-
-def _get_time_from_match(match):
-    if match:
-        return datetime.datetime.strptime(match, "%H:%M").time()
+    if end_hour is None:
+        end = datetime.date(int(end_year), int(end_month), int(end_day))
     else:
-        return None
+        end = datetime.datetime(int(end_year), int(end_month), int(end_day),
+                                int(end_hour), int(end_minute))
+    return start, end
 
 
 def _get_time_from_line(line):
-    # Extract the following information in capture groups:
-    # 1 - start date
-    # 2 - start time
-    # 3 - end date
-    # 4 - end time
-    match = re.search("(\d{1,2}/\d{1,2}-\d{4})(?: (\d{2}:\d{2}) til "
-                      "(\d{1,2}/\d{1,2}-\d{4})? ?(\d{2}:\d{2}))?", line)
+    match = _TIME_FIELDS.search(line)
     if match is None:
         raise InvalidTimeLineError("No time found in line: '{}'".format(line))
+    return _get_time_from_fields(*match.groups())
 
-    start_date = _get_date_from_match(match.group(1))
-    start_time = _get_time_from_match(match.group(2))
 
-    if start_time:
-        start = datetime.datetime.combine(start_date, start_time)
-    else:
-        start = start_date
-
-    end_date = _get_date_from_match(match.group(3))
-    end_time = _get_time_from_match(match.group(4))
-
-    if not end_date:
-        end_date = start_date
-
-    if end_time:
-        end = datetime.datetime.combine(end_date, end_time)
-    else:
-        end = end_date
-    return start, end
-
-
-def _add_line_to_text(line, text):
-    if text != "":
-        text += "\n"
-    text += line
-    return text
-
-
-def _add_section_to_summary(section, summary):
-    if summary != "" and section != "":
-        summary += " " + u"\u2022" + " "
-    summary += section
-    return summary
+def _get_time_from_header_match(match, line):
+    # The time is taken from the first date in the line. Only when an
+    # earlier date, not followed by a time, comes before the one which
+    # classified the line do the two differ.
+    if _DATE.search(line).start() != match.start("start_day"):
+        return _get_time_from_line(line)
+    return _get_time_from_fields(*match.group("start_day", "start_month",
+                                              "start_year", "start_hour",
+                                              "start_minute", "end_day",
+                                              "end_month", "end_year",
+                                              "end_hour", "end_minute"))
 
 
 def _get_info_from_title(title):
-    summary = description = ""
+    summary_sections = []
+    description = ""
     status = start_time = end_time = location = None
     lines = title.splitlines()
-    headerSection = True
-    for line in lines:
-        if headerSection:
-            if line == '':
-                headerSection = False
-                continue
-            if _is_status_line(line):
-                status = _get_status_from_line(line)
-            elif _is_time_line(line):
-                start_time, end_time = _get_time_from_line(line)
-            elif _is_location_line(line):
-                location = _get_location_from_line(line)
-            else:
-                summary = _add_section_to_summary(line, summary)
+    for i, line in enumerate(lines):
+        if line == '':
+            # Everything after the header is the description, except for
+            # any empty lines leading it.
+            description_lines = lines[i + 1:]
+            while description_lines and description_lines[0] == '':
+                del description_lines[0]
+            description = "\n".join(description_lines)
+            break
+        match = _HEADER_LINE.match(line)
+        if match is None:
+            summary_sections.append(line)
+        elif match.group("status") is not None:
+            status = _get_status_from_line(line)
+        elif match.group("start_day") is not None:
+            start_time, end_time = _get_time_from_header_match(match, line)
         else:
-            description = _add_line_to_text(line, description)
+            location = match.group("location")
+    summary = " • ".join(summary_sections)
     return summary, status, start_time, end_time, location, description
 
 
-def _parse_element_to_lesson(element):
+def _get_lesson_key(element):
+    # The link holds the lesson's absid, but the tooltip is part of the
+    # key too, so a changed lesson is never mistaken for the old one.
+    return element.get("href"), element.get("data-additionalinfo")
+
+
+def _parse_element_to_lesson(element, school_store=None):
+    if school_store is not None:
+        return school_store.get_lesson(
+            _get_lesson_key(element),
+            lambda: _parse_element_to_lesson(element))
+    return lesson.Lesson(*_get_lesson_arguments(element))
+
+
+def _get_lesson_arguments(element):
     link = element.get("href")
     id = None
     if link:
@@ -203,56 +275,287 @@ def _parse_element_to_lesson(element):
         link = _get_complete_link(link)
     summary, status, start_time, end_time, location, description = \
         _get_info_from_title(element.get("data-additionalinfo"))
-    return lesson.Lesson(id, summary, status, start_time, end_time, location, description, link)
+    return (id, summary, status, start_time, end_time, location, description,
+            link)
+
+
+class _LessonElementTarget(object):
+    """ Parser target keeping only the attributes of lesson links.
+
+    Used instead of building the whole tree of the page, as the lessons are
+    all that is needed from it. Text and end tags aren't needed either, so
+    the target has no data and end methods, which lxml then skips.
+    """
+
+    def __init__(self):
+        self.elements = []
+
+    def start(self, tag, attrib):
+        # Matches all a elements with class s2skemabrik in the page
+        if tag == "a":
+            classes = attrib.get("class")
+            if classes and LESSON_CLASS in classes.split():
+                self.elements.append(attrib)
+
+    def close(self):
+        return self.elements
+
 
+def _parse_page_to_elements(page):
+    # Parsers hold state while parsing, so every page gets its own.
+    parser = etree.HTMLParser(target=_LessonElementTarget())
+    return etree.fromstring(page, parser)
 
-def _parse_page_to_lessons(page):
-    tree = html.fromstring(page)
-    # Find all a elements with class s2skemabrik in page
-    lesson_elements = tree.xpath("//a[contains(concat("
-                                 "' ', normalize-space(@class), ' '),"
-                                 "' s2skemabrik ')]")
+
+def _parse_page_to_lesson_arguments(page):
+    # Runs in the processes of a parse pool, so it must not record metrics,
+    # which would never reach the registry of the parent. Only the keys and
+    # arguments of the lessons are sent back, as tuples of strings and dates
+    # pickle faster than the lessons themselves.
+    return [(_get_lesson_key(element), _get_lesson_arguments(element))
+            for element in _parse_page_to_elements(page)]
+
+
+def _create_lesson(key, arguments, school_store=None):
+    if school_store is not None:
+        return school_store.get_lesson(
+            key, functools.partial(lesson.Lesson, *arguments))
+    return lesson.Lesson(*arguments)
+
+
+@metrics.timed("lectio_page_parse")
+def _parse_page_to_lessons(page, school_store=None, parse_pool=None):
+    if parse_pool is not None:
+        return [_create_lesson(key, arguments, school_store)
+                for key, arguments in parse_pool.submit(
+                    _parse_page_to_lesson_arguments, page).result()]
     lessons = []
-    for element in lesson_elements:
-        lessons.append(_parse_element_to_lesson(element))
+    for element in _parse_page_to_elements(page):
+        lessons.append(_parse_element_to_lesson(element, school_store))
     return lessons
 
 
-def _retreive_week_schedule(school_id, user_type, user_id, week):
-    r = _get_user_page(school_id, user_type, user_id, week)
-    schedule = _parse_page_to_lessons(r.content)
-    return schedule
+def _get_conditional_headers(cached):
+    headers = {}
+    if cached is not None:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+    return headers
+
+
+def _fetch_week(session, school_id, user_type, user_id, week, page_cache):
+    if page_cache is None:
+        cached = None
+    else:
+        cached = page_cache.get((school_id, user_type, user_id, week))
+    r = _get_user_page(session, school_id, user_type, user_id, week,
+                       _get_conditional_headers(cached))
+    return r, cached
+
+
+def _get_week_lessons(r, cached, key, page_cache, school_store=None,
+                      parse_pool=None):
+    if page_cache is None:
+        return _parse_page_to_lessons(r.content, school_store, parse_pool)
+    if cached is not None and r.status_code == requests.codes.not_modified:
+        metrics.increment("lectio_pages_unchanged")
+        return cached["lessons"]
+    # Lectio rarely answers conditional requests, so an unchanged page is
+    # mostly recognized by the hash of its content.
+    digest = hashlib.sha256(r.content).hexdigest()
+    entry = {"etag": r.headers.get("ETag"),
+             "last_modified": r.headers.get("Last-Modified"),
+             "digest": digest}
+    if cached is not None and cached["digest"] == digest:
+        metrics.increment("lectio_pages_unchanged")
+        lessons = cached["lessons"]
+        # get has already marked the entry as used, so it's only written
+        # again if the page came with new validators.
+        if all(cached[name] == value for name, value in entry.items()):
+            return lessons
+    else:
+        lessons = _parse_page_to_lessons(r.content, school_store,
+                                         parse_pool)
+    entry["lessons"] = lessons
+    page_cache.put(key, entry)
+    return lessons
+
+
+def _retreive_week_schedule(session, school_id, user_type, user_id, week,
+                            page_cache=None, school_store=None,
+                            parse_pool=None):
+    r, cached = _fetch_week(session, school_id, user_type, user_id, week,
+                            page_cache)
+    return _get_week_lessons(r, cached, (school_id, user_type, user_id, week),
+                             page_cache, school_store, parse_pool)
 
 
 def _filter_for_duplicates(schedule):
     filtered_schedule = []
+    seen = set()
     for lesson in schedule:
-        if lesson not in filtered_schedule:
+        if lesson not in seen:
+            seen.add(lesson)
             filtered_schedule.append(lesson)
     return filtered_schedule
 
 
-def _retreive_user_schedule(school_id, user_type, user_id, n_weeks):
-    schedule = []
-    for week_offset in range(n_weeks + 1):
-        week = _get_lectio_weekformat_with_offset(week_offset)
-        week_schedule = _retreive_week_schedule(school_id,
-                                                user_type,
-                                                user_id,
-                                                week)
-        schedule += week_schedule
-    filtered_schedule = _filter_for_duplicates(schedule)
-    return filtered_schedule
+def _spans_weeks(lesson):
+    end = lesson.end
+    if isinstance(end, datetime.datetime):
+        end = end.date()
+    return end >= fingerprint.get_week(lesson) + datetime.timedelta(weeks=1)
+
+
+def _filter_week_for_duplicates(lessons, spanning):
+    # Lessons of different weeks only repeat if they span several weeks,
+    # so only those are remembered from one week to the next, and what is
+    # remembered doesn't grow with the number of weeks.
+    seen = set()
+    for lesson in lessons:
+        if lesson in seen or lesson in spanning:
+            continue
+        seen.add(lesson)
+        if _spans_weeks(lesson):
+            spanning.add(lesson)
+        yield lesson
+
+
+def _iter_user_schedule(session, school_id, user_type, user_id, weeks,
+                        first_page, concurrency, page_cache, school_store,
+                        parse_pool, failed_weeks):
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        # The first week has already been downloaded when checking that
+        # the user exists, so only its parsing is left to do.
+        r, cached = first_page
+        pending = collections.deque([(weeks[0], executor.submit(
+            _get_week_lessons,
+            r,
+            cached,
+            (school_id, user_type, user_id, weeks[0]),
+            page_cache,
+            school_store,
+            parse_pool))])
+        next_weeks = iter(weeks[1:])
+        spanning = set()
+        while pending:
+            # Only concurrency weeks are fetched ahead of the lessons
+            # yielded, so the pages of a long schedule are never all held.
+            for week in itertools.islice(next_weeks,
+                                         concurrency + 1 - len(pending)):
+                pending.append((week, executor.submit(
+                    _retreive_week_schedule,
+                    session,
+                    school_id,
+                    user_type,
+                    user_id,
+                    week,
+                    page_cache,
+                    school_store,
+                    parse_pool)))
+            # Weeks are yielded in order, regardless of the order the
+            # fetches complete in, so the schedule stays deterministic.
+            week, future = pending.popleft()
+            try:
+                lessons = future.result()
+            except Exception as err:
+                failed_weeks[week] = err
+                continue
+            for lesson in _filter_week_for_duplicates(lessons, spanning):
+                yield lesson
+
+
+def _get_weeks(n_weeks):
+    return [_get_lectio_weekformat_with_offset(week_offset)
+            for week_offset in range(n_weeks + 1)]
+
 
+def _raise_for_failed_weeks(weeks, schedule, failed_weeks):
+    if failed_weeks:
+        raise ScheduleRetrievalError("Couldn't retrieve weeks: {}".format(
+                                     ", ".join(week for week in weeks
+                                               if week in failed_weeks)),
+                                     schedule, failed_weeks)
 
-def _user_exists(school_id, user_type, user_id):
-    r = _get_user_page(school_id, user_type, user_id)
-    return r.status_code == requests.codes.ok
 
+def _user_exists(response):
+    return response.status_code in (requests.codes.ok,
+                                    requests.codes.not_modified)
 
-def get_schedule(school_id, user_type, user_id, n_weeks):
-    if not _user_exists(school_id, user_type, user_id):
+
+def _fetch_first_week(session, school_id, user_type, user_id, weeks,
+                      page_cache):
+    first_page = _fetch_week(session, school_id, user_type, user_id,
+                             weeks[0], page_cache)
+    if not _user_exists(first_page[0]):
         raise UserDoesNotExistError("Couldn't find user - school: {}, "
                                     "type: {}, id: {} - in Lectio.".format(
                                         school_id, user_type, user_id))
-    return _retreive_user_schedule(school_id, user_type, user_id, n_weeks)
+    return first_page
+
+
+def iter_schedule(school_id, user_type, user_id, n_weeks, concurrency=1,
+                  session=None, page_cache=None, school_store=None,
+                  parse_pool=None):
+    """ Yield the lessons of the schedule week by week, as they arrive.
+
+    Only concurrency weeks are downloaded ahead of the lessons yielded, so
+    the pages of the whole schedule are never held at once. A lesson found
+    in several weeks, which it only is if it spans them, is only yielded
+    the first time. Besides the pages in flight, only such lessons are
+    held from one week to the next, so it's up to the caller whether the
+    whole schedule is; get_schedule keeps it all.
+    If some weeks couldn't be retrieved, ScheduleRetrievalError is raised
+    after the lessons of the other weeks have been yielded, with an empty
+    schedule.
+    """
+    if session is None:
+        session = create_session(pool_size=concurrency)
+    weeks = _get_weeks(n_weeks)
+    first_page = _fetch_first_week(session, school_id, user_type, user_id,
+                                   weeks, page_cache)
+    failed_weeks = {}
+    for lesson in _iter_user_schedule(session, school_id, user_type, user_id,
+                                      weeks, first_page, concurrency,
+                                      page_cache, school_store,
+                                      parse_pool, failed_weeks):
+        yield lesson
+    _raise_for_failed_weeks(weeks, [], failed_weeks)
+
+
+def get_schedule(school_id, user_type, user_id, n_weeks, concurrency=1,
+                 session=None, page_cache=None, school_store=None,
+                 parse_pool=None):
+    schedule = []
+    try:
+        for lesson in iter_schedule(school_id, user_type, user_id, n_weeks,
+                                    concurrency, session, page_cache,
+                                    school_store, parse_pool):
+            schedule.append(lesson)
+    except ScheduleRetrievalError as err:
+        raise ScheduleRetrievalError(str(err), schedule, err.failed_weeks)
+    return schedule
+
+
+def get_teams_schedule(school_id, team_ids, n_weeks, concurrency=1,
+                       session=None, page_cache=None, school_store=None,
+                       parse_pool=None):
+    """ The combined schedule of the teams with ids team_ids.
+
+    With a school_store, each team's schedule is only fetched once per
+    cycle of the store, for all the users who are part of the team.
+    """
+    schedule = []
+    for team_id in team_ids:
+        fetch = functools.partial(get_schedule, school_id, "team", team_id,
+                                  n_weeks, concurrency, session, page_cache,
+                                  school_store, parse_pool)
+        if school_store is None:
+            schedule += fetch()
+        else:
+            schedule += school_store.get_schedule(
+                (school_id, team_id, n_weeks), fetch)
+    # Lessons shared by teams are only kept once.
+    return _filter_for_duplicates(schedule)
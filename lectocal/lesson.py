@@ -12,20 +12,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
 import hashlib
 import datetime
+import sys
 
 STATUS_COLORS = {"normal": "10", "changed": "5", "cancelled": "11"}
+TIME_ZONE = "Europe/Copenhagen"
+
+
+def _share(value):
+    # Summaries and locations repeat across most lessons of a schedule, so
+    # every lesson refers to a single copy of each distinct value.
+    if value is None:
+        return None
+    return sys.intern(value)
+
+
+def _format_time(time):
+    if type(time) == datetime.datetime:
+        return {"timeZone": TIME_ZONE, "dateTime": time.isoformat()}
+    else:
+        return {"timeZone": TIME_ZONE, "date": time.isoformat()}
 
 
 class Lesson(object):
+    """ A single lesson, from either Lectio or Google Calendar.
+
+    Lessons are hashable, and must not be changed once they are created.
+    """
+
+    __slots__ = ("id", "summary", "status", "start", "end", "location",
+                 "description", "link", "_digest")
+
     def __init__(self, id, summary, status, start, end, location, description, link):
-        self.summary = summary
+        self.summary = _share(summary)
         self.status = status or "normal"
         self.start = start
         self.end = end
-        self.location = location
+        self.location = _share(location)
         self.description = description
         self.link = link
 
@@ -34,40 +58,35 @@ class Lesson(object):
         else:
             self.id = id
 
-    def to_gcalendar_format(self):
-        TEMPLATE = {
-            "summary": None,
-            "id": None,
-            "colorId": None,
-            "start": {
-                "timeZone": "Europe/Copenhagen"
-            },
-            "end": {
-                "timeZone": "Europe/Copenhagen"
-            },
-            "location": None,
-            "description": None,
-            "source": {}
+        self._digest = None
 
+    def to_gcalendar_format(self):
+        # The event body is built directly, rather than by copying a
+        # template, as this runs for every lesson written to Google.
+        return {
+            "summary": self.summary,
+            "id": self.id,
+            "colorId": STATUS_COLORS[self.status],
+            "start": _format_time(self.start),
+            "end": _format_time(self.end),
+            "location": self.location,
+            "description": self.description,
+            "source": {} if self.link is None else {"url": self.link}
         }
 
-        formatted = copy.deepcopy(TEMPLATE)
-        formatted["summary"] = self.summary
-        formatted["id"] = self.id
-        formatted["colorId"] = STATUS_COLORS[self.status]
-        if type(self.start) == datetime.datetime:
-            formatted["start"]["dateTime"] = self.start.isoformat()
-        else:
-            formatted["start"]["date"] = self.start.isoformat()
-        if type(self.end) == datetime.datetime:
-            formatted["end"]["dateTime"] = self.end.isoformat()
-        else:
-            formatted["end"]["date"] = self.end.isoformat()
-        formatted["location"] = self.location
-        formatted["description"] = self.description
-        if self.link is not None:
-            formatted["source"]["url"] = self.link
-        return formatted
+    def content_key(self):
+        """ Hashable key which is equal for lessons that are equal. """
+        return (self.id, self.summary, self.status, self.start, self.end,
+                self.location, self.description, self.link)
+
+    @property
+    def digest(self):
+        """ SHA-256 of the lesson's content, stable between processes. """
+        if self._digest is None:
+            hasher = hashlib.sha256()
+            hasher.update(bytes(repr(self.content_key()), "utf8"))
+            self._digest = hasher.hexdigest()
+        return self._digest
 
     def _gen_id(self):
         lesson_string = str(self.summary) + str(self.status) + \
@@ -80,10 +99,25 @@ class Lesson(object):
         return hash_value
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if type(self) == type(other):
-            return self.__dict__ == other.__dict__
+            # Lessons with different ids are told apart without looking
+            # at the rest of their content.
+            return self.id == other.id and \
+                   self.content_key() == other.content_key()
         return False
 
+    def __hash__(self):
+        # Equal lessons have equal ids, and strings cache their own hash,
+        # so this costs neither time nor memory per lesson.
+        return hash(self.id)
+
+    def __reduce__(self):
+        return (Lesson, (self.id, self.summary, self.status, self.start,
+                         self.end, self.location, self.description,
+                         self.link))
+
     def __ne__(self, other):
         return not self.__eq__(other)
 
@@ -95,5 +129,10 @@ class Lesson(object):
 
 
 def schedules_are_identical(schedule1, schedule2):
-    return all(lesson in schedule1 for lesson in schedule2) and \
-           all(lesson in schedule2 for lesson in schedule1)
+    return set(schedule1) == set(schedule2)
+
+
+def schedule_to_events(schedule):
+    """ Generate the Google Calendar event body of each lesson in turn. """
+    for lesson in schedule:
+        yield lesson.to_gcalendar_format()
@@ -0,0 +1,110 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import functools
+import threading
+import time
+
+PROMETHEUS_PREFIX = "lectocal_"
+
+
+class Registry(object):
+    """ Thread-safe counters and timers, collected over a run.
+
+    Counters are plain sums. Timers keep the number of observations, and
+    the total and longest time observed, in seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._started = time.time()
+            self._counters = {}
+            self._timers = {}
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                self._timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+
+    def snapshot(self):
+        """ The counters and timers as a JSON serializable report. """
+        with self._lock:
+            return {"started": self._started,
+                    "duration": time.time() - self._started,
+                    "counters": dict(self._counters),
+                    "timers": {name: {"count": count,
+                                      "total": total,
+                                      "max": longest}
+                               for name, (count, total, longest)
+                               in self._timers.items()}}
+
+    def to_prometheus(self):
+        """ The counters and timers in the Prometheus text format. """
+        report = self.snapshot()
+        lines = []
+        for name, value in sorted(report["counters"].items()):
+            metric = "{}{}_total".format(PROMETHEUS_PREFIX, name)
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, value))
+        for name, timer in sorted(report["timers"].items()):
+            metric = "{}{}_seconds".format(PROMETHEUS_PREFIX, name)
+            lines.append("# TYPE {} summary".format(metric))
+            lines.append("{}_count {}".format(metric, timer["count"]))
+            lines.append("{}_sum {}".format(metric, timer["total"]))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def increment(name, value=1):
+    REGISTRY.increment(name, value)
+
+
+@contextlib.contextmanager
+def timer(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(name, time.perf_counter() - started)
+
+
+def timed(name):
+    """ Decorator observing the time of every call under name. """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                REGISTRY.observe(name, time.perf_counter() - started)
+        return wrapper
+    return decorator
@@ -0,0 +1,113 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024
+# Bumped whenever the layout of the cached entries changes, so entries
+# written by an older version are never read back.
+CACHE_FORMAT = 2
+ENTRY_SUFFIX = ".page"
+
+
+class PageCache(object):
+    """ On-disk cache of downloaded Lectio pages and their parsed lessons.
+
+    Entries are keyed by (school_id, user_type, user_id, week). When the
+    cache grows beyond max_size bytes, the least recently used entries are
+    evicted. The directory is only listed once, on the first put, after
+    which the size and order of the entries are kept in memory.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # Size of each entry by path, from the least to the most recently
+        # used, once the directory has been listed.
+        self._entries = None
+        self._total_size = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_path(self, key):
+        hasher = hashlib.sha256()
+        hasher.update(bytes(repr((CACHE_FORMAT,) + tuple(key)), "utf8"))
+        return os.path.join(self.directory,
+                            hasher.hexdigest() + ENTRY_SUFFIX)
+
+    def get(self, key):
+        """ The entry stored for key, or None if there isn't one. """
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+            # The modification time orders the entries for eviction, the
+            # next time the directory is listed.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError, TypeError, ValueError):
+            return None
+        with self._lock:
+            if self._entries is not None and path in self._entries:
+                self._entries.move_to_end(path)
+        return entry
+
+    def put(self, key, entry):
+        path = self._get_path(key)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with open(fd, "wb") as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        with self._lock:
+            if self._entries is None:
+                self._list_entries()
+            self._total_size += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+            self._evict()
+
+    def _list_entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(ENTRY_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, entry.path, stat.st_size))
+        entries.sort()
+        self._entries = collections.OrderedDict(
+            (path, size) for mtime, path, size in entries)
+        self._total_size = sum(self._entries.values())
+
+    def _evict(self):
+        while self._total_size > self.max_size:
+            path, size = self._entries.popitem(last=False)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self._total_size -= size
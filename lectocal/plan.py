@@ -0,0 +1,145 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+import math
+import os
+import sys
+import time
+from . import batch
+from . import diff
+from . import lesson
+from . import state
+
+# Bumped whenever the layout of a plan changes, so plans written by an
+# older version are refused rather than misread.
+PLAN_FORMAT = 2
+STDOUT = "-"
+
+
+class PlanError(Exception):
+    """ A plan can't be read, doesn't belong to the user applying it, or is
+    out of date.
+    """
+
+
+class Plan(collections.namedtuple("Plan", ["changeset", "create_calendar",
+                                           "fingerprints", "reconciled",
+                                           "base_fingerprints",
+                                           "base_reconciled"])):
+    """ The changes a sync will make to a calendar, worked out in advance.
+
+    fingerprints and reconciled are saved once the changes are made, as if
+    the sync had run when the plan was made. base_fingerprints and
+    base_reconciled are those the plan was worked out from.
+    """
+
+    __slots__ = ()
+
+    def is_empty(self):
+        return not self.create_calendar and self.changeset.is_empty()
+
+
+def _get_owner(user):
+    return {"school_id": user.school_id,
+            "user_type": user.user_type,
+            "user_id": user.user_id,
+            "credentials": os.path.abspath(user.credentials),
+            "calendar": user.calendar,
+            "teams": user.teams}
+
+
+def _estimate(sync_plan):
+    # Each request in a batch counts against the quota on its own.
+    operations = len(sync_plan.changeset.adds) + \
+        len(sync_plan.changeset.updates) + \
+        len(sync_plan.changeset.deletes)
+    requests = math.ceil(operations / batch.MAX_BATCH_SIZE)
+    if sync_plan.create_calendar:
+        operations += 1
+        requests += 1
+    return {"http_requests": requests, "quota_units": operations}
+
+
+def to_json(sync_plan, user):
+    changeset = sync_plan.changeset
+    return {"format": PLAN_FORMAT,
+            "planned": time.time(),
+            "owner": _get_owner(user),
+            "create_calendar": sync_plan.create_calendar,
+            "counts": {"insert": len(changeset.adds),
+                       "update": len(changeset.updates),
+                       "delete": len(changeset.deletes)},
+            "estimate": _estimate(sync_plan),
+            "insert": list(lesson.schedule_to_events(changeset.adds)),
+            "update": list(lesson.schedule_to_events(changeset.updates)),
+            "delete": list(lesson.schedule_to_events(changeset.deletes)),
+            "fingerprints": sync_plan.fingerprints,
+            "reconciled": sync_plan.reconciled,
+            "base_fingerprints": sync_plan.base_fingerprints,
+            "base_reconciled": sync_plan.base_reconciled}
+
+
+def from_json(data, user):
+    """ The plan in data, checked to belong to user. """
+    # The events are decoded the way they are when read from Google.
+    from . import gcalendar
+    if data.get("format") != PLAN_FORMAT:
+        raise PlanError("Plan format {} is not supported"
+                        .format(data.get("format")))
+    if data["owner"] != _get_owner(user):
+        raise PlanError("Plan was made for {}, not {}".format(
+                        data["owner"], _get_owner(user)))
+    changeset = diff.Changeset(gcalendar.parse_events(data["insert"]),
+                               gcalendar.parse_events(data["update"]),
+                               gcalendar.parse_events(data["delete"]))
+    return Plan(changeset, data["create_calendar"], data["fingerprints"],
+                data["reconciled"], data["base_fingerprints"],
+                data["base_reconciled"])
+
+
+def check_current(sync_plan, fingerprints, reconciled):
+    """ Raise PlanError unless fingerprints and reconciled, as saved now,
+    are those sync_plan was worked out from.
+
+    A plan applied after another sync has been made would undo the changes
+    of that sync, and save fingerprints older than those it saved.
+    """
+    if fingerprints != sync_plan.base_fingerprints or \
+            reconciled != sync_plan.base_reconciled:
+        raise PlanError("The calendar has been synced since the plan was "
+                        "made, make a new plan")
+
+
+def write(path, sync_plan, user):
+    """ Write the plan as JSON to path, or to stdout if path is "-". """
+    data = to_json(sync_plan, user)
+    if path == STDOUT:
+        json.dump(data, sys.stdout, indent=2, ensure_ascii=False)
+        sys.stdout.write("\n")
+    else:
+        state.save_json(path, data)
+
+
+def read(path, user):
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as err:
+        raise PlanError("Couldn't read plan: {} ({!r})".format(path, err))
+    try:
+        return from_json(data, user)
+    except (KeyError, TypeError) as err:
+        raise PlanError("Malformed plan: {} ({!r})".format(path, err))
@@ -0,0 +1,110 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from . import metrics
+
+DEFAULT_USER_QPS = 5.0
+DEFAULT_PROJECT_QPS = 100.0
+# Lets a user send one full batch at once, before being paced.
+DEFAULT_USER_BURST = 50
+# On a quota error the rate is halved, and every success after that adds
+# back a tenth of the configured rate, until it is reached again.
+DECREASE_FACTOR = 0.5
+INCREASE_FRACTION = 0.1
+MIN_QPS = 0.1
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket, refilled with rate tokens per second.
+
+    The rate adapts to quota errors with additive increase, multiplicative
+    decrease, between MIN_QPS and the configured rate. Acquiring more tokens
+    than the bucket holds puts it in debt, which later callers wait out, so
+    a batch bigger than the burst is still let through at the right rate.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """ Take tokens from the bucket, waiting until they are available."""
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            if self._tokens < 0:
+                wait = -self._tokens / self.rate
+            else:
+                wait = 0
+        if wait:
+            metrics.REGISTRY.observe("rate_limit_wait", wait)
+            time.sleep(wait)
+
+    def decrease(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(MIN_QPS, self.rate * DECREASE_FACTOR)
+
+    def increase(self):
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate,
+                            self.rate + self.max_rate * INCREASE_FRACTION)
+
+
+class RateLimiter(object):
+    """ Paces the requests of one user against their own quota and the
+    quota of the project, which is shared by every user.
+    """
+
+    def __init__(self, user_bucket, project_bucket=None):
+        self.user_bucket = user_bucket
+        self.project_bucket = project_bucket
+
+    def _buckets(self):
+        if self.project_bucket is None:
+            return (self.user_bucket,)
+        return (self.user_bucket, self.project_bucket)
+
+    def acquire(self, requests=1):
+        for bucket in self._buckets():
+            bucket.acquire(requests)
+
+    def succeeded(self):
+        for bucket in self._buckets():
+            bucket.increase()
+
+    def throttled(self, user_only=False):
+        """ Slow down after a quota error.
+
+        If the error was for the user's own quota, the other users sharing
+        the project are left at their rate.
+        """
+        if user_only:
+            self.user_bucket.decrease()
+        else:
+            for bucket in self._buckets():
+                bucket.decrease()
@@ -0,0 +1,53 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+
+try:
+    from importlib.resources import as_file, files
+except ImportError:
+    as_file = files = None
+try:
+    # Python 3.7 and 3.8 only have the functions taking a package and a
+    # name, which are used when files isn't there.
+    import importlib.resources as importlib_resources
+except ImportError:
+    # Before Python 3.7, package data is found through pkg_resources,
+    # which is only imported when needed, as importing it is slow.
+    importlib_resources = None
+
+
+def read_text(name):
+    """ Contents of the data file name, shipped in the lectocal package. """
+    if files is not None:
+        return files(__package__).joinpath(name).read_text(encoding="utf-8")
+    if importlib_resources is not None:
+        return importlib_resources.read_text(__package__, name,
+                                             encoding="utf-8")
+    import pkg_resources
+    return pkg_resources.resource_string(__package__, name).decode("utf-8")
+
+
+@contextlib.contextmanager
+def path(name):
+    """ Context manager giving a path to the data file name on disk. """
+    if files is not None:
+        with as_file(files(__package__).joinpath(name)) as resource_path:
+            yield str(resource_path)
+    elif importlib_resources is not None:
+        with importlib_resources.path(__package__, name) as resource_path:
+            yield str(resource_path)
+    else:
+        import pkg_resources
+        yield pkg_resources.resource_filename(__package__, name)
@@ -13,25 +13,44 @@
 # limitations under the License.
 
 import argparse
-from . import gauth
+import concurrent.futures
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+from . import diff
+from . import fingerprint
 from . import lectio
-from . import lesson
-from . import gcalendar
+from . import metrics
+from . import pagecache
+from . import plan
+from . import ratelimit
+from . import state
 
+DEFAULT_FULL_SYNC_INTERVAL = 24 * 60 * 60
 
-def _get_arguments():
-    parser = argparse.ArgumentParser(description="Scrapes a Lectio schedule "
-                                     "and syncs it to Google Calendar.")
-    parser.add_argument("school_id",
-                        type=int,
-                        help="ID of the school user belongs to in Lectio.")
-    parser.add_argument("user_type",
-                        choices=["student", "teacher"],
-                        help="User type in Lectio. "
-                        "(options: student, teacher)")
-    parser.add_argument("user_id",
-                        type=int,
-                        help="User's ID in Lectio.")
+logger = logging.getLogger(__name__)
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive integer"
+                                         .format(value))
+    return number
+
+
+def positive_float(value):
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("{} is not a positive number"
+                                         .format(value))
+    return number
+
+
+def add_user_arguments(parser):
     parser.add_argument("--credentials",
                         default="storage.json",
                         help="Path to the file storing the Google "
@@ -45,27 +64,498 @@ def _get_arguments():
                         default=4,
                         help="Number of weeks to parse the schedule for. "
                         "(default: 4)")
+    parser.add_argument("--teams",
+                        type=int,
+                        nargs="+",
+                        metavar="TEAM_ID",
+                        help="Sync the schedules of these Lectio teams "
+                        "instead of the user's own schedule.")
+
+
+def add_sync_arguments(parser):
+    parser.add_argument("--lectio-concurrency",
+                        type=positive_int,
+                        default=1,
+                        help="Number of weeks to fetch from Lectio at the "
+                        "same time. (default: 1)")
+    parser.add_argument("--lectio-timeout",
+                        type=float,
+                        default=lectio.DEFAULT_TIMEOUT,
+                        help="Seconds to wait for Lectio before giving up "
+                        "on a request. (default: {})"
+                        .format(lectio.DEFAULT_TIMEOUT))
+    parser.add_argument("--lectio-retries",
+                        type=int,
+                        default=lectio.DEFAULT_RETRIES,
+                        help="Number of times a failed Lectio request is "
+                        "retried, with exponential backoff. (default: {})"
+                        .format(lectio.DEFAULT_RETRIES))
+    parser.add_argument("--parse-workers",
+                        type=positive_int,
+                        help="Number of processes to parse Lectio pages in, "
+                        "so parsing isn't limited to one core. (default: "
+                        "pages are parsed by the threads fetching them)")
+    parser.add_argument("--page-cache",
+                        action="store_true",
+                        help="Cache downloaded Lectio pages in the state "
+                        "directory, and skip parsing pages which haven't "
+                        "changed.")
+    parser.add_argument("--page-cache-size",
+                        type=int,
+                        default=pagecache.DEFAULT_MAX_SIZE // 1024 ** 2,
+                        help="Maximum size of the page cache in megabytes. "
+                        "(default: {})"
+                        .format(pagecache.DEFAULT_MAX_SIZE // 1024 ** 2))
+    parser.add_argument("--state-dir",
+                        default=state.DEFAULT_STATE_DIR,
+                        help="Directory for state kept between runs, such "
+                        "as cached calendar ids. (default: {})"
+                        .format(state.DEFAULT_STATE_DIR))
+    parser.add_argument("--calendar-id-ttl",
+                        type=int,
+                        default=state.DEFAULT_ID_CACHE_TTL,
+                        help="Seconds a cached calendar id is trusted "
+                        "before it is looked up again. (default: {})"
+                        .format(state.DEFAULT_ID_CACHE_TTL))
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="Keep a local mirror of the calendar in the "
+                        "state directory, and only download the events "
+                        "changed since the last run.")
+    parser.add_argument("--sync-store",
+                        action="store_true",
+                        help="Keep the lessons synced to each calendar in "
+                        "a SQLite store in the state directory, and compare "
+                        "changed weeks with it instead of reading Google "
+                        "Calendar between full syncs.")
+    parser.add_argument("--google-qps",
+                        type=positive_float,
+                        default=ratelimit.DEFAULT_USER_QPS,
+                        help="Requests per second sent to Google Calendar "
+                        "for each user. Halved on quota errors, and raised "
+                        "back gradually. (default: {})"
+                        .format(ratelimit.DEFAULT_USER_QPS))
+    parser.add_argument("--google-project-qps",
+                        type=positive_float,
+                        default=ratelimit.DEFAULT_PROJECT_QPS,
+                        help="Requests per second sent to Google Calendar "
+                        "for all users together. (default: {})"
+                        .format(ratelimit.DEFAULT_PROJECT_QPS))
+    parser.add_argument("--full-sync-interval",
+                        type=int,
+                        default=DEFAULT_FULL_SYNC_INTERVAL,
+                        help="Seconds between syncs which compare every "
+                        "week with Google Calendar. Syncs in between only "
+                        "compare the weeks changed in Lectio, so edits "
+                        "made in Google Calendar are repaired at the next "
+                        "full sync. (default: {})"
+                        .format(DEFAULT_FULL_SYNC_INTERVAL))
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics-out",
+                        help="Write a JSON report of the time spent and the "
+                        "requests made while syncing to this file.")
+
+
+def _get_arguments():
+    parser = argparse.ArgumentParser(description="Scrapes a Lectio schedule "
+                                     "and syncs it to Google Calendar.")
+    parser.add_argument("school_id",
+                        type=int,
+                        help="ID of the school user belongs to in Lectio.")
+    parser.add_argument("user_type",
+                        choices=["student", "teacher"],
+                        help="User type in Lectio. "
+                        "(options: student, teacher)")
+    parser.add_argument("user_id",
+                        type=int,
+                        help="User's ID in Lectio.")
+    add_user_arguments(parser)
+    add_sync_arguments(parser)
+    add_metrics_arguments(parser)
+    plan_group = parser.add_mutually_exclusive_group()
+    plan_group.add_argument("--plan",
+                            metavar="PLAN",
+                            help="Work out the changes to the calendar, and "
+                            "write them as a JSON plan to this file, or to "
+                            "stdout if it is -, without making them.")
+    plan_group.add_argument("--apply",
+                            metavar="PLAN",
+                            help="Make the changes in a plan written by "
+                            "--plan, instead of working them out.")
+    parser.add_argument("--profile",
+                        help="Profile the run with cProfile, and dump the "
+                        "stats of all its threads to this file.")
+    parser.add_argument("--verbose",
+                        action="store_true",
+                        help="Log what the run did, such as the requests "
+                        "sent to Google Calendar. Only warnings and errors "
+                        "are logged otherwise.")
 
     return parser.parse_args()
 
 
+def create_lectio_session(options, pool_size=None):
+    return lectio.create_session(timeout=options.lectio_timeout,
+                                 retries=options.lectio_retries,
+                                 pool_size=pool_size or
+                                 options.lectio_concurrency)
+
+
+def create_page_cache(options):
+    if not options.page_cache:
+        return None
+    return pagecache.PageCache(os.path.join(options.state_dir, "pages"),
+                               options.page_cache_size * 1024 ** 2)
+
+
+def create_parse_pool(options):
+    """ Process pool for parsing Lectio pages, or None without workers.
+
+    A worker forked while another thread holds a lock, such as that of the
+    metrics registry, would inherit it locked for good. The workers are
+    started by a fork server instead, or where the pool can't be given one,
+    all at once before any of the threads syncing users exist.
+    """
+    if not options.parse_workers:
+        return None
+    if sys.version_info >= (3, 7):
+        import multiprocessing
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = multiprocessing.get_context("spawn")
+        return concurrent.futures.ProcessPoolExecutor(options.parse_workers,
+                                                      mp_context=context)
+    parse_pool = concurrent.futures.ProcessPoolExecutor(options.parse_workers)
+    # The first task makes the pool start every one of its workers.
+    parse_pool.submit(int).result()
+    return parse_pool
+
+
+def create_sync_store(options):
+    if not options.sync_store:
+        return None
+    from . import syncstore
+    return syncstore.SyncStore(os.path.join(options.state_dir,
+                                            syncstore.STORE_NAME))
+
+
+def create_project_bucket(options):
+    return ratelimit.TokenBucket(options.google_project_qps)
+
+
+def create_google_client(credentials_path, options, project_bucket=None):
+    """ Calendar client for the credentials at credentials_path.
+
+    Clients sharing a project_bucket share the quota of the project.
+    """
+    # Google's client libraries are a large part of the startup time, so
+    # they are only imported once a sync needs to talk to Google.
+    from . import gauth
+    from . import gcalendar
+    google_credentials = gauth.get_credentials(credentials_path)
+    id_cache_path = state.get_path(options.state_dir, "calendars",
+                                   os.path.abspath(credentials_path))
+    rate_limiter = ratelimit.RateLimiter(
+        ratelimit.TokenBucket(options.google_qps,
+                              ratelimit.DEFAULT_USER_BURST),
+        project_bucket or create_project_bucket(options))
+    return gcalendar.CalendarClient(google_credentials,
+                                    id_cache_path,
+                                    options.calendar_id_ttl,
+                                    rate_limiter)
+
+
+def describe_transfer(counts):
+    """ Summary of the transfer counts of a Calendar client, where counts
+    is None if no client was made.
+    """
+    if counts is None:
+        return "Google Calendar wasn't contacted"
+    return "{} Calendar requests, {} bytes sent, {} bytes received once " \
+           "decompressed ({} responses gzipped)".format(
+               counts["requests"],
+               counts["bytes_sent"],
+               counts["bytes_received_decompressed"],
+               counts["compressed_responses"])
+
+
+def _get_fingerprint_path(user, options):
+    return state.get_path(options.state_dir, "weeks",
+                          os.path.abspath(user.credentials),
+                          user.calendar, user.school_id,
+                          user.user_type, user.user_id)
+
+
+def _get_lectio_schedule(user, options, lectio_session, page_cache=None,
+                         school_store=None, parse_pool=None):
+    if user.teams:
+        return lectio.get_teams_schedule(user.school_id,
+                                         user.teams,
+                                         user.weeks,
+                                         options.lectio_concurrency,
+                                         lectio_session,
+                                         page_cache,
+                                         school_store,
+                                         parse_pool)
+    return lectio.get_schedule(user.school_id,
+                               user.user_type,
+                               user.user_id,
+                               user.weeks,
+                               options.lectio_concurrency,
+                               lectio_session,
+                               page_cache,
+                               school_store,
+                               parse_pool)
+
+
+def _get_google_schedule(user, options, get_google_client,
+                         changed_weeks=None, sync_store=None):
+    # Returns None if the user's calendar doesn't exist yet.
+    from . import gcalendar
+    google_client = get_google_client()
+    if not gcalendar.has_calendar(google_client, user.calendar):
+        return None
+    if options.incremental:
+        sync_state_path = state.get_path(options.state_dir, "events",
+                                         os.path.abspath(user.credentials),
+                                         user.calendar)
+    else:
+        sync_state_path = None
+    google_schedule = gcalendar.get_schedule(google_client,
+                                             user.calendar,
+                                             user.weeks,
+                                             sync_state_path,
+                                             changed_weeks)
+    if sync_store is not None and changed_weeks is None:
+        sync_store.verify(user, google_schedule)
+    return google_schedule
+
+
+def plan_sync(user, options, get_google_client, lectio_session,
+              page_cache=None, school_store=None, parse_pool=None,
+              sync_store=None):
+    """ Work out the changes a sync of user would make, without making
+    them, and return them as a plan.Plan.
+
+    Only the weeks which changed in Lectio since the last sync are compared
+    with Google Calendar, except every full_sync_interval seconds, when
+    every week is. As Google Calendar is then read whatever Lectio holds,
+    it is read while Lectio is scraped.
+    With a sync_store, the weeks which changed are compared with the
+    store, and Google Calendar is only read on full syncs, which verify
+    the store.
+    """
+    written_fingerprints, written_reconciled = fingerprint.load(
+        _get_fingerprint_path(user, options))
+    reconciled = written_reconciled
+    now = time.time()
+    full_sync = now - reconciled >= options.full_sync_interval or \
+        (sync_store is not None and sync_store.get_verified(user) is None)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        if full_sync:
+            google_future = executor.submit(_get_google_schedule, user,
+                                            options, get_google_client,
+                                            None, sync_store)
+        lectio_schedule = _get_lectio_schedule(user, options, lectio_session,
+                                               page_cache, school_store,
+                                               parse_pool)
+        fingerprints = fingerprint.fingerprint_schedule(
+            lectio_schedule, fingerprint.get_weeks(user.weeks))
+        if full_sync:
+            changed_weeks = None
+            reconciled = now
+            google_schedule = google_future.result()
+        else:
+            changed_weeks = fingerprint.get_changed_weeks(
+                written_fingerprints, fingerprints)
+            if not changed_weeks:
+                metrics.increment("unchanged_syncs")
+                return plan.Plan(diff.Changeset([], [], []), False,
+                                 fingerprints, reconciled,
+                                 written_fingerprints, written_reconciled)
+            if sync_store is not None:
+                google_schedule = sync_store.get_schedule(user,
+                                                          changed_weeks)
+            else:
+                google_schedule = _get_google_schedule(user, options,
+                                                       get_google_client,
+                                                       changed_weeks)
+    if google_schedule is None:
+        # Nothing written before applies to a new calendar, and there is
+        # nothing in it to compare with.
+        return plan.Plan(diff.Changeset(lectio_schedule, [], []), True,
+                         fingerprints, now,
+                         written_fingerprints, written_reconciled)
+    if changed_weeks is not None:
+        lectio_schedule = [lesson for lesson in lectio_schedule
+                           if fingerprint.get_week(lesson) in changed_weeks]
+    with metrics.timer("diff"):
+        changeset = diff.diff_schedules(google_schedule, lectio_schedule)
+    return plan.Plan(changeset, False, fingerprints, reconciled,
+                     written_fingerprints, written_reconciled)
+
+
+def apply_plan(user, options, get_google_client, sync_plan,
+               sync_store=None):
+    """ Make the changes in sync_plan to the calendar of user, and record
+    them in sync_store, if given.
+    """
+    fingerprint_path = _get_fingerprint_path(user, options)
+    plan.check_current(sync_plan, *fingerprint.load(fingerprint_path))
+    if not sync_plan.is_empty():
+        from . import gcalendar
+        google_client = get_google_client()
+        if sync_plan.create_calendar and \
+                not gcalendar.has_calendar(google_client, user.calendar):
+            gcalendar.create_calendar(google_client, user.calendar)
+            if sync_store is not None:
+                # A new calendar is known to be empty without reading it.
+                sync_store.verify(user, [])
+        if not sync_plan.changeset.is_empty():
+            from . import batch
+            try:
+                results = gcalendar.update_calendar_with_schedule(
+                    google_client, user.calendar, sync_plan.changeset)
+            except batch.BatchError as err:
+                # The operations which succeeded are in the calendar, so
+                # they are recorded before giving up on the rest.
+                if sync_store is not None:
+                    sync_store.record(user, err.results)
+                raise
+            if sync_store is not None:
+                sync_store.record(user, results)
+    # Saved only once the calendar has been updated, so weeks which failed
+    # to be written are compared again on the next sync.
+    fingerprint.save(fingerprint_path, sync_plan.fingerprints,
+                     sync_plan.reconciled)
+
+
+def sync_user(user, options, get_google_client, lectio_session,
+              page_cache=None, school_store=None, parse_pool=None,
+              sync_store=None):
+    """ Sync the Lectio schedule of a user into their Google calendar.
+
+    user holds the school_id, user_type, user_id, credentials, calendar,
+    weeks and teams to sync. options holds the options from add_sync_arguments.
+    get_google_client returns the Calendar client for the user, and is
+    only called if Google Calendar must be read or written.
+    Returns the changeset which was applied to the calendar.
+    """
+    sync_plan = plan_sync(user, options, get_google_client, lectio_session,
+                          page_cache, school_store, parse_pool, sync_store)
+    apply_plan(user, options, get_google_client, sync_plan, sync_store)
+    return sync_plan.changeset
+
+
+class _Profiler(object):
+    """ cProfile profiler covering the threads started while it's enabled.
+
+    Before Python 3.12, a cProfile profiler only profiles the thread
+    enabling it, so every thread started meanwhile, such as those fetching
+    Lectio weeks or reading Google Calendar, gets a profiler of its own.
+    Their stats are merged when dumped.
+    """
+
+    def __init__(self):
+        self._profiles = [cProfile.Profile()]
+        self._lock = threading.Lock()
+
+    def _profile_thread(self, frame, event, arg):
+        # Called on the first event of a new thread, and replaced by its
+        # profiler from then on.
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def enable(self):
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._profile_thread)
+        self._profiles[0].enable()
+
+    def disable(self):
+        self._profiles[0].disable()
+        threading.setprofile(None)
+
+    def dump_stats(self, path):
+        import pstats
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            # pstats refuses profiles without stats, which a thread ending
+            # right after it was started could leave.
+            profile.create_stats()
+            if profile.stats:
+                stats.add(profile)
+        stats.dump_stats(path)
+
+
+def write_metrics(path):
+    state.save_json(path, metrics.REGISTRY.snapshot())
+
+
 def main():
     arguments = _get_arguments()
-    google_credentials = gauth.get_credentials(arguments.credentials)
-    if not gcalendar.has_calendar(google_credentials, arguments.calendar):
-        gcalendar.create_calendar(google_credentials, arguments.calendar)
-    lectio_schedule = lectio.get_schedule(arguments.school_id,
-                                          arguments.user_type,
-                                          arguments.user_id,
-                                          arguments.weeks)
-    google_schedule = gcalendar.get_schedule(google_credentials,
-                                             arguments.calendar,
-                                             arguments.weeks)
-    if not lesson.schedules_are_identical(lectio_schedule, google_schedule):
-        gcalendar.update_calendar_with_schedule(google_credentials,
-                                                arguments.calendar,
-                                                google_schedule,
-                                                lectio_schedule)
+    logging.basicConfig(level=logging.INFO if arguments.verbose
+                        else logging.WARNING,
+                        format="%(message)s")
+    if arguments.profile:
+        profiler = _Profiler()
+        profiler.enable()
+    google_clients = []
+
+    def get_google_client():
+        if not google_clients:
+            google_clients.append(create_google_client(arguments.credentials,
+                                                       arguments))
+        return google_clients[0]
+
+    parse_pool = create_parse_pool(arguments)
+    sync_store = create_sync_store(arguments)
+    try:
+        if arguments.apply:
+            apply_plan(arguments,
+                       arguments,
+                       get_google_client,
+                       plan.read(arguments.apply, arguments),
+                       sync_store)
+        elif arguments.plan:
+            plan.write(arguments.plan,
+                       plan_sync(arguments,
+                                 arguments,
+                                 get_google_client,
+                                 create_lectio_session(arguments),
+                                 create_page_cache(arguments),
+                                 parse_pool=parse_pool,
+                                 sync_store=sync_store),
+                       arguments)
+        else:
+            sync_user(arguments,
+                      arguments,
+                      get_google_client,
+                      create_lectio_session(arguments),
+                      create_page_cache(arguments),
+                      parse_pool=parse_pool,
+                      sync_store=sync_store)
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+        if sync_store is not None:
+            sync_store.close()
+        # Failed runs are reported too, as they are the ones to look into.
+        if arguments.profile:
+            profiler.disable()
+            profiler.dump_stats(arguments.profile)
+        if arguments.metrics_out:
+            write_metrics(arguments.metrics_out)
+    if google_clients:
+        logger.info(describe_transfer(google_clients[0].pop_transfer_counts()))
+    else:
+        logger.info(describe_transfer(None))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,81 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import concurrent.futures
+import threading
+
+DEFAULT_MAX_LESSONS = 100000
+
+
+class SchoolStore(object):
+    """ Lessons and team schedules shared by the users of one process.
+
+    Students of a school share most of their lessons, so a lesson parsed
+    for one user is kept and handed to every other user with the same
+    lesson, up to max_lessons lessons, least recently used first out.
+    Team schedules are fetched once per cycle, however many users they
+    are part of.
+    """
+
+    def __init__(self, max_lessons=DEFAULT_MAX_LESSONS):
+        self.max_lessons = max_lessons
+        self._lessons = collections.OrderedDict()
+        self._lessons_lock = threading.Lock()
+        self._schedules = {}
+        self._schedules_lock = threading.Lock()
+
+    def get_lesson(self, key, parse):
+        """ The lesson stored for key, or the lesson returned by parse,
+        which is then stored.
+        """
+        with self._lessons_lock:
+            lesson = self._lessons.get(key)
+            if lesson is not None:
+                self._lessons.move_to_end(key)
+                return lesson
+        lesson = parse()
+        with self._lessons_lock:
+            # Another thread may have parsed the same lesson meanwhile, and
+            # the first one stored is the one shared.
+            lesson = self._lessons.setdefault(key, lesson)
+            while len(self._lessons) > self.max_lessons:
+                self._lessons.popitem(last=False)
+        return lesson
+
+    def get_schedule(self, key, fetch):
+        """ The schedule fetched for key this cycle, fetching it if it
+        hasn't been. Users asking while it is fetched wait for it.
+        """
+        with self._schedules_lock:
+            future = self._schedules.get(key)
+            fetching = future is None
+            if fetching:
+                future = concurrent.futures.Future()
+                self._schedules[key] = future
+        if fetching:
+            try:
+                future.set_result(fetch())
+            except BaseException as err:
+                # Failures aren't kept, so the next user tries again.
+                with self._schedules_lock:
+                    if self._schedules.get(key) is future:
+                        del self._schedules[key]
+                future.set_exception(err)
+        return future.result()
+
+    def new_cycle(self):
+        """ Forget the schedules fetched, so they are fetched again. """
+        with self._schedules_lock:
+            self._schedules = {}
@@ -0,0 +1,61 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import tempfile
+
+DEFAULT_STATE_DIR = ".lectocal"
+# Kept here rather than in gcalendar, so run can show it as a default
+# without importing Google's libraries.
+DEFAULT_ID_CACHE_TTL = 24 * 60 * 60
+
+
+def get_path(state_dir, name, *key):
+    """ Path of the state file called name, belonging to key.
+
+    The key parts are hashed, so state belonging to different users,
+    credentials or calendars is kept in separate files.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(bytes(json.dumps([str(part) for part in key]), "utf8"))
+    return os.path.join(state_dir, "{}-{}.json".format(
+                        name, hasher.hexdigest()[:16]))
+
+
+def load_json(path, default=None):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except ValueError:
+        # A corrupt state file is treated like a missing one, the state
+        # is rebuilt from scratch.
+        return default
+
+
+def save_json(path, data):
+    """ Write data to path atomically, so readers never see half a file. """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
@@ -0,0 +1,237 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from . import fingerprint
+from . import state
+
+STORE_NAME = "sync.sqlite3"
+# Bumped whenever the schema changes. A store of another format is
+# dropped and rebuilt, which the next verification of each calendar does.
+STORE_FORMAT = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS calendars (
+    credentials TEXT NOT NULL,
+    calendar TEXT NOT NULL,
+    school_id INTEGER NOT NULL,
+    user_type TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    verified REAL NOT NULL,
+    PRIMARY KEY (credentials, calendar)
+);
+CREATE INDEX IF NOT EXISTS calendars_school ON calendars (school_id);
+CREATE TABLE IF NOT EXISTS lessons (
+    credentials TEXT NOT NULL,
+    calendar TEXT NOT NULL,
+    id TEXT NOT NULL,
+    week TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    status TEXT NOT NULL,
+    event TEXT NOT NULL,
+    etag TEXT,
+    synced REAL NOT NULL,
+    PRIMARY KEY (credentials, calendar, id)
+);
+CREATE INDEX IF NOT EXISTS lessons_week
+    ON lessons (credentials, calendar, week);
+"""
+
+
+def _get_key(user):
+    return os.path.abspath(user.credentials), user.calendar
+
+
+def _parse_events(events):
+    # The events are decoded the way they are when read from Google.
+    from . import gcalendar
+    return gcalendar.parse_events(json.loads(event) for event in events)
+
+
+class SyncStore(object):
+    """ SQLite store of the lessons last synced to each calendar.
+
+    For every lesson in a calendar, the store holds its id, the week it
+    starts in, its digest and status, the event written to Google and the
+    etag Google gave it. A calendar's lessons are replaced whenever the
+    calendar is read from Google, which verifies them, and are updated
+    with every change written to it in between.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # The connection is shared by the threads syncing users, and
+        # guarded by the lock.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            store_format = self._connection.execute(
+                "PRAGMA user_version").fetchone()[0]
+            if store_format != STORE_FORMAT:
+                self._connection.execute("DROP TABLE IF EXISTS lessons")
+                self._connection.execute("DROP TABLE IF EXISTS calendars")
+                self._connection.execute("PRAGMA user_version = {}"
+                                         .format(STORE_FORMAT))
+            self._connection.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def get_verified(self, user):
+        """ When the calendar of user was last read from Google, or None
+        if it never has been.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT verified FROM calendars "
+                "WHERE credentials = ? AND calendar = ?",
+                _get_key(user)).fetchone()
+        return None if row is None else row[0]
+
+    def get_schedule(self, user, weeks):
+        """ The lessons of the calendar of user starting in weeks, as the
+        first days of ISO weeks.
+        """
+        credentials, calendar = _get_key(user)
+        events = []
+        with self._lock:
+            for week in weeks:
+                events += [row[0] for row in self._connection.execute(
+                    "SELECT event FROM lessons WHERE credentials = ? AND "
+                    "calendar = ? AND week = ?",
+                    (credentials, calendar, week.isoformat()))]
+        return _parse_events(events)
+
+    def _put_lesson(self, key, lesson, etag, synced):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO lessons VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            key + (lesson.id,
+                   fingerprint.get_week(lesson).isoformat(),
+                   lesson.digest,
+                   lesson.status,
+                   json.dumps(lesson.to_gcalendar_format()),
+                   etag,
+                   synced))
+
+    def verify(self, user, schedule):
+        """ Replace the lessons of the calendar of user with schedule, as
+        read from Google.
+        """
+        key = _get_key(user)
+        now = time.time()
+        with self._lock, self._connection:
+            # Etags aren't part of the events read, so those of lessons
+            # which haven't changed are kept.
+            etags = {id: (digest, etag) for id, digest, etag in
+                     self._connection.execute(
+                         "SELECT id, digest, etag FROM lessons "
+                         "WHERE credentials = ? AND calendar = ?", key)}
+            self._connection.execute(
+                "DELETE FROM lessons WHERE credentials = ? AND calendar = ?",
+                key)
+            for lesson in schedule:
+                digest, etag = etags.get(lesson.id, (None, None))
+                if digest != lesson.digest:
+                    etag = None
+                self._put_lesson(key, lesson, etag, now)
+            self._connection.execute(
+                "INSERT OR REPLACE INTO calendars VALUES (?, ?, ?, ?, ?, ?)",
+                key + (user.school_id, user.user_type, user.user_id, now))
+
+    def record(self, user, results):
+        """ Record the results of the operations written to the calendar
+        of user, as returned by batch.execute.
+        """
+        from . import batch
+        key = _get_key(user)
+        now = time.time()
+        with self._lock, self._connection:
+            for operation, response in results:
+                if operation.kind == batch.DELETE:
+                    self._connection.execute(
+                        "DELETE FROM lessons WHERE credentials = ? AND "
+                        "calendar = ? AND id = ?",
+                        key + (operation.lesson.id,))
+                else:
+                    etag = response.get("etag") if response else None
+                    self._put_lesson(key, operation.lesson, etag, now)
+
+    def get_school_schedule(self, school_id, week, status=None):
+        """ The lessons of school_id starting in week, across the calendars
+        of all its users. Only lessons with status are returned, if given.
+        """
+        query = "SELECT DISTINCT lessons.id, lessons.event FROM lessons " \
+                "JOIN calendars USING (credentials, calendar) " \
+                "WHERE calendars.school_id = ? AND lessons.week = ?"
+        parameters = (school_id, week.isoformat())
+        if status is not None:
+            query += " AND lessons.status = ?"
+            parameters += (status,)
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        # A lesson is in the calendar of every user taking part in it.
+        events = {}
+        for id, event in rows:
+            events.setdefault(id, event)
+        return _parse_events(events.values())
+
+
+def _parse_week(value):
+    day = datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    return fingerprint.get_week_of_day(day)
+
+
+def _get_arguments():
+    parser = argparse.ArgumentParser(description="Prints the lessons of a "
+                                     "school in a week, as last synced, "
+                                     "without contacting Lectio or Google.")
+    parser.add_argument("school_id", type=int, help="ID of the school.")
+    parser.add_argument("--week",
+                        type=_parse_week,
+                        help="Any day of the week, as YYYY-MM-DD. "
+                        "(default: this week)")
+    parser.add_argument("--status",
+                        choices=("normal", "changed", "cancelled"),
+                        help="Only print lessons with this status.")
+    parser.add_argument("--state-dir",
+                        default=state.DEFAULT_STATE_DIR,
+                        help="Directory holding the sync store. "
+                        "(default: {})".format(state.DEFAULT_STATE_DIR))
+    return parser.parse_args()
+
+
+def main():
+    arguments = _get_arguments()
+    store = SyncStore(os.path.join(arguments.state_dir, STORE_NAME))
+    week = arguments.week or fingerprint.get_weeks(0)[0]
+    try:
+        for lesson in store.get_school_schedule(arguments.school_id, week,
+                                                arguments.status):
+            json.dump(lesson.to_gcalendar_format(), sys.stdout,
+                      ensure_ascii=False)
+            sys.stdout.write("\n")
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
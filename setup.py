@@ -42,7 +42,7 @@ setup(
         "License :: OSI Approved :: Apache Software License"
     ],
     keywords="lectio google calendar sync utility",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "tests"]),
     install_requires=[
         "google-api-python-client",
         "requests",
@@ -51,14 +51,19 @@ setup(
         "python-dateutil",
         "oauth2client"
     ],
+    extras_require={
+        "yaml": ["PyYAML"]
+    },
     package_data={
         "lectocal": [
             "client_secret.json",
+            "calendar_discovery.json",
         ]
     },
     entry_points={
         "console_scripts": [
             "lectocal.run=lectocal.run:main",
+            "lectocal.daemon=lectocal.daemon:main",
             "lectocal.gauth=lectocal.gauth:main"
         ]
     }
@@ -0,0 +1,133 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" The tooltip parser as it was before the header lines were classified in
+one match, kept to check the current parser against.
+"""
+
+import datetime
+import re
+from lectocal import lectio
+
+
+def _is_status_line(line):
+    match = re.search("Ændret!|Aflyst!", line)
+    return match is not None
+
+
+def _is_location_line(line):
+    match = re.search("Lokaler?: ", line)
+    return match is not None
+
+
+def _is_time_line(line):
+    match = re.search(r"\d{1,2}/\d{1,2}-\d{4} (?:Hele dagen|\d{2}:\d{2} til "
+                      r"(?:\d{1,2}/\d{1,2}-\d{4} )?\d{2}:\d{2})", line)
+    return match is not None
+
+
+def _get_status_from_line(line):
+    try:
+        return lectio.LESSON_STATUS[line]
+    except KeyError:
+        raise lectio.InvalidStatusError("Line: '{}' has no valid status"
+                                        .format(line))
+
+
+def _get_location_from_line(line):
+    match = re.search("Lokaler?: (.*)", line)
+    if match is None:
+        raise lectio.InvalidLocationError("No location found in line: '{}'"
+                                          .format(line))
+    return match.group(1)
+
+
+def _get_date_from_match(match):
+    if match:
+        return datetime.datetime.strptime(match, "%d/%m-%Y").date()
+    else:
+        return None
+
+
+def _get_time_from_match(match):
+    if match:
+        return datetime.datetime.strptime(match, "%H:%M").time()
+    else:
+        return None
+
+
+def _get_time_from_line(line):
+    match = re.search(r"(\d{1,2}/\d{1,2}-\d{4})(?: (\d{2}:\d{2}) til "
+                      r"(\d{1,2}/\d{1,2}-\d{4})? ?(\d{2}:\d{2}))?", line)
+    if match is None:
+        raise lectio.InvalidTimeLineError("No time found in line: '{}'"
+                                          .format(line))
+
+    start_date = _get_date_from_match(match.group(1))
+    start_time = _get_time_from_match(match.group(2))
+
+    if start_time:
+        start = datetime.datetime.combine(start_date, start_time)
+    else:
+        start = start_date
+
+    end_date = _get_date_from_match(match.group(3))
+    end_time = _get_time_from_match(match.group(4))
+
+    if not end_date:
+        end_date = start_date
+
+    if end_time:
+        end = datetime.datetime.combine(end_date, end_time)
+    else:
+        end = end_date
+    return start, end
+
+
+def _add_line_to_text(line, text):
+    if text != "":
+        text += "\n"
+    text += line
+    return text
+
+
+def _add_section_to_summary(section, summary):
+    if summary != "" and section != "":
+        summary += " " + u"•" + " "
+    summary += section
+    return summary
+
+
+def get_info_from_title(title):
+    summary = description = ""
+    status = start_time = end_time = location = None
+    lines = title.splitlines()
+    headerSection = True
+    for line in lines:
+        if headerSection:
+            if line == '':
+                headerSection = False
+                continue
+            if _is_status_line(line):
+                status = _get_status_from_line(line)
+            elif _is_time_line(line):
+                start_time, end_time = _get_time_from_line(line)
+            elif _is_location_line(line):
+                location = _get_location_from_line(line)
+            else:
+                summary = _add_section_to_summary(line, summary)
+        else:
+            description = _add_line_to_text(line, description)
+    return summary, status, start_time, end_time, location, description
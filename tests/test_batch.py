@@ -0,0 +1,155 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import socket
+import unittest
+from benchmarks import common
+from benchmarks import fakes
+from lectocal import batch
+from lectocal import gcalendar
+
+CALENDAR_ID = "calendar@group.calendar.google.com"
+
+
+class _FailingCalendarHttp(fakes.FakeCalendarHttp):
+    """ Fake Calendar API failing the requests it is told to.
+
+    failures maps an event id to the statuses its next writes fail with.
+    failed_batches holds the numbers of the batches, counting from 1, whose
+    connection times out, and rejected_batches those refused as a whole.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.calendars[CALENDAR_ID] = {"summary": "Lectio", "events": {}}
+        self.failures = {}
+        self.failed_batches = set()
+        self.rejected_batches = set()
+        self.batches = 0
+
+    @property
+    def events(self):
+        return self.calendars[CALENDAR_ID]["events"]
+
+    def _batch(self, body, headers):
+        self.batches += 1
+        if self.batches in self.failed_batches:
+            raise socket.timeout("timed out")
+        if self.batches in self.rejected_batches:
+            return self._response(*fakes._error(401, "authError"))
+        return super()._batch(body, headers)
+
+    def _handle(self, method, path, query, body):
+        event_id = json.loads(body)["id"] if body else path.split("/")[-1]
+        if self.failures.get(event_id):
+            return fakes._error(self.failures[event_id].pop(0), "failed")
+        return super()._handle(method, path, query, body)
+
+
+class ExecuteTest(unittest.TestCase):
+    def setUp(self):
+        self.http = _FailingCalendarHttp()
+        self.service = gcalendar._build_service(self.http)
+        self.schedule = common.make_schedule(120)
+
+    def _execute(self, operations):
+        return batch.execute(self.service, CALENDAR_ID, operations,
+                             max_attempts=3, backoff=0)
+
+    def _inserts(self, schedule):
+        return [batch.Operation(batch.INSERT, lesson) for lesson in schedule]
+
+    def _get_lessons(self, results):
+        return [(operation.kind, operation.lesson) for operation, response
+                in results]
+
+    def test_inserts(self):
+        results = self._execute(self._inserts(self.schedule))
+        self.assertEqual(self._get_lessons(results),
+                         [(batch.INSERT, lesson) for lesson in self.schedule])
+        self.assertEqual(self.http.batches, 3)
+        self.assertEqual(len(self.http.events), 120)
+
+    def test_insert_of_existing_id_becomes_update(self):
+        self._execute(self._inserts(self.schedule[:1]))
+        results = self._execute(self._inserts(self.schedule[:2]))
+        self.assertEqual(self._get_lessons(results),
+                         [(batch.INSERT, self.schedule[1]),
+                          (batch.UPDATE, self.schedule[0])])
+
+    def test_deletes_of_missing_events_are_done(self):
+        self._execute(self._inserts(self.schedule[:1]))
+        results = self._execute([batch.Operation(batch.DELETE, lesson)
+                                 for lesson in self.schedule[:2]])
+        self.assertEqual(self._get_lessons(results),
+                         [(batch.DELETE, lesson)
+                          for lesson in self.schedule[:2]])
+        self.assertEqual(self.http.events[self.schedule[0].id]["status"],
+                         "cancelled")
+
+    def test_only_failed_operations_are_retried(self):
+        self.http.failures[self.schedule[5].id] = [503]
+        results = self._execute(self._inserts(self.schedule[:10]))
+        self.assertEqual(self._get_lessons(results),
+                         [(batch.INSERT, lesson) for lesson in
+                          self.schedule[:5] + self.schedule[6:10] +
+                          self.schedule[5:6]])
+        self.assertEqual(self.http.batches, 2)
+
+    def test_timed_out_batch_is_retried(self):
+        self.http.failed_batches.add(2)
+        results = self._execute(self._inserts(self.schedule))
+        self.assertEqual(len(results), 120)
+        self.assertEqual(self.http.batches, 4)
+        self.assertEqual(len(self.http.events), 120)
+
+    def test_failed_operations_keep_results(self):
+        self.http.failures[self.schedule[0].id] = [400]
+        self.http.failures[self.schedule[1].id] = [503]
+        # The retried operations only fit in one batch on the last attempt.
+        self.http.failed_batches.update((2, 4, 6))
+        with self.assertRaises(batch.BatchError) as context:
+            self._execute(self._inserts(self.schedule))
+        err = context.exception
+        self.assertEqual(self._get_lessons(err.results),
+                         [(batch.INSERT, lesson) for lesson in
+                          self.schedule[2:50] + self.schedule[100:] +
+                          self.schedule[99:100]])
+        self.assertEqual([operation.lesson for operation, error
+                          in err.failed_operations],
+                         self.schedule[:2] + self.schedule[50:99])
+        self.assertEqual(err.failed_operations[0][1].resp.status, 400)
+        self.assertIsInstance(err.failed_operations[1][1], socket.timeout)
+        self.assertEqual(len(self.http.events), 69)
+
+
+    def test_rejected_batch_keeps_results(self):
+        self.http.failures[self.schedule[0].id] = [503]
+        self.http.rejected_batches.add(2)
+        with self.assertRaises(batch.BatchError) as context:
+            self._execute(self._inserts(self.schedule))
+        err = context.exception
+        self.assertEqual(self._get_lessons(err.results),
+                         [(batch.INSERT, lesson)
+                          for lesson in self.schedule[1:50]])
+        self.assertEqual([operation.lesson for operation, error
+                          in err.failed_operations],
+                         self.schedule[50:] + self.schedule[:1])
+        self.assertEqual(err.__cause__.resp.status, 401)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import datetime
+import unittest
+from lectocal import batch
+from lectocal import diff
+from lectocal import fingerprint
+from lectocal import gcalendar
+from lectocal import lesson
+
+
+def _make_lesson(id, week):
+    start = datetime.datetime.combine(week, datetime.time(8))
+    return lesson.Lesson(str(id), "Hold: 1.a Ma", None, start,
+                         start + datetime.timedelta(minutes=45), "Lokale: 1",
+                         "", None)
+
+
+class GetOperationsTest(unittest.TestCase):
+    def test_weeks_are_written_in_order(self):
+        this_week, next_week, later_week = fingerprint.get_weeks(2)
+        lessons = [_make_lesson(id, week) for id, week in enumerate(
+            [this_week] * 3 + [next_week] * 2 + [later_week] * 2)]
+        changeset = diff.Changeset(adds=[lessons[3], lessons[0]],
+                                   updates=[lessons[5], lessons[1]],
+                                   deletes=[lessons[6], lessons[4],
+                                            lessons[2]])
+        self.assertEqual([(operation.kind, operation.lesson) for operation
+                          in gcalendar._get_operations(changeset)],
+                         [(batch.DELETE, lessons[2]),
+                          (batch.INSERT, lessons[0]),
+                          (batch.UPDATE, lessons[1]),
+                          (batch.DELETE, lessons[4]),
+                          (batch.INSERT, lessons[3]),
+                          (batch.DELETE, lessons[6]),
+                          (batch.UPDATE, lessons[5])])
+
+
+if __name__ == "__main__":
+    unittest.main()
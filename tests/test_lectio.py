@@ -0,0 +1,204 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import datetime
+import html
+import json
+import os
+import re
+import unittest
+import requests
+import requests.adapters
+from benchmarks import common
+from lectocal import fingerprint
+from lectocal import lectio
+from . import reference_lectio
+
+TOOLTIPS_PATH = os.path.join(os.path.dirname(__file__), "tooltips.json")
+LECTIO_WEEK = re.compile(r"week=(\d{6})")
+
+
+def _load_tooltips():
+    with open(TOOLTIPS_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class GetInfoFromTitleTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tooltips = _load_tooltips()
+
+    def _get_info(self, name):
+        return lectio._get_info_from_title(self.tooltips[name])
+
+    def test_matches_reference_parser(self):
+        for name, tooltip in sorted(self.tooltips.items()):
+            with self.subTest(tooltip=name):
+                self.assertEqual(lectio._get_info_from_title(tooltip),
+                                 reference_lectio.get_info_from_title(tooltip))
+
+    def test_normal(self):
+        summary, status, start, end, location, description = \
+            self._get_info("normal")
+        self.assertEqual(summary, "Hold: 2.b Ma • Lærer: Karen Holm (KH)")
+        self.assertIsNone(status)
+        self.assertEqual(start, datetime.datetime(2017, 10, 2, 8, 15))
+        self.assertEqual(end, datetime.datetime(2017, 10, 2, 9, 45))
+        self.assertEqual(location, "214")
+        self.assertEqual(description, "Lektier:\n- Opgave 4.12 og 4.13")
+
+    def test_changed(self):
+        self.assertEqual(self._get_info("changed")[1], "changed")
+
+    def test_cancelled(self):
+        self.assertEqual(self._get_info("cancelled")[1], "cancelled")
+
+    def test_multi_teacher(self):
+        summary, status, start, end, location, description = \
+            self._get_info("multi_teacher")
+        self.assertIn("Lærere: Karen Holm (KH), Peter Vang (PV), "
+                      "Anne Jensen (AJ)", summary)
+        self.assertEqual(location, "214, 215")
+
+    def test_no_room(self):
+        self.assertIsNone(self._get_info("no_room")[4])
+        self.assertEqual(self._get_info("no_room_no_description")[5], "")
+
+    def test_midnight_spanning(self):
+        summary, status, start, end, location, description = \
+            self._get_info("midnight_spanning")
+        self.assertEqual(start, datetime.datetime(2016, 4, 8, 17, 30))
+        self.assertEqual(end, datetime.datetime(2016, 4, 9, 1, 0))
+
+    def test_all_day(self):
+        summary, status, start, end, location, description = \
+            self._get_info("all_day")
+        self.assertEqual(start, datetime.date(2016, 3, 14))
+        self.assertEqual(end, datetime.date(2016, 3, 14))
+
+
+
+class _WeekAdapter(requests.adapters.BaseAdapter):
+    """ Transport adapter answering each week with the page given for it.
+
+    Weeks without a page fail to connect.
+    """
+
+    def __init__(self, pages):
+        super().__init__()
+        self.pages = pages
+
+    def send(self, request, **kwargs):
+        week = LECTIO_WEEK.search(request.url).group(1)
+        if week not in self.pages:
+            raise requests.ConnectionError("No page for week {}".format(week))
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.status_code = 200
+        response._content = self.pages[week]
+        return response
+
+    def close(self):
+        pass
+
+
+def _make_tooltip(start, end):
+    return "Studietur\n{0.day}/{0.month}-{0.year} {0:%H:%M} til " \
+           "{1.day}/{1.month}-{1.year} {1:%H:%M}\nHold: 3.a".format(start,
+                                                                   end)
+
+
+def _make_week_page(week, lesson_links):
+    # The five lessons of the week, followed by those given as (id,
+    # tooltip) pairs.
+    links = "".join(
+        "<a class='s2skemabrik' href='/lectio/1/aktivitet/aktivitetforside2"
+        ".aspx?absid={}' data-additionalinfo='{}'></a>".format(
+            id, html.escape(tooltip))
+        for id, tooltip in lesson_links)
+    return common.make_week_page(5, week, week.toordinal()).replace(
+        b"</table>", links.encode("utf-8") + b"</table>")
+
+
+class ScheduleTest(unittest.TestCase):
+    N_WEEKS = 3
+
+    def setUp(self):
+        mondays = [datetime.datetime.combine(week, datetime.time(8))
+                   for week in fingerprint.get_weeks(self.N_WEEKS)]
+        # The trip spans the first two weeks, and the course the last
+        # three, so they are found in each of those weeks.
+        trip = (1, _make_tooltip(mondays[0] + datetime.timedelta(days=4),
+                                 mondays[1]))
+        course = (2, _make_tooltip(mondays[1], mondays[3]))
+        self.weeks = lectio._get_weeks(self.N_WEEKS)
+        self.pages = dict(zip(self.weeks, [
+            _make_week_page(mondays[0].date(), [trip]),
+            _make_week_page(mondays[1].date(), [trip, course]),
+            _make_week_page(mondays[2].date(), [course]),
+            _make_week_page(mondays[3].date(), [course])]))
+
+    def _get_lessons(self):
+        return lectio._filter_for_duplicates([
+            lesson for week in self.weeks if week in self.pages
+            for lesson in lectio._parse_page_to_lessons(self.pages[week])])
+
+    def _create_session(self):
+        session = requests.Session()
+        session.mount("https://", _WeekAdapter(self.pages))
+        return session
+
+    def _get_schedule(self, concurrency=1):
+        return lectio.get_schedule(1, "student", 1, self.N_WEEKS,
+                                   concurrency, self._create_session())
+
+    def _iter_schedule(self, concurrency=1):
+        return list(lectio.iter_schedule(1, "student", 1, self.N_WEEKS,
+                                         concurrency, self._create_session()))
+
+    def test_spans_weeks(self):
+        lessons = lectio._parse_page_to_lessons(self.pages[self.weeks[1]])
+        # The five lessons of the week, then the trip and the course.
+        self.assertEqual([lectio._spans_weeks(lesson) for lesson in lessons],
+                         [False] * 5 + [True, True])
+
+    def test_spanning_lessons_are_yielded_once(self):
+        expected = self._get_lessons()
+        self.assertEqual(len(expected), 22)
+        for concurrency in (1, 3):
+            with self.subTest(concurrency=concurrency):
+                self.assertEqual(self._get_schedule(concurrency), expected)
+                self.assertEqual(self._iter_schedule(concurrency), expected)
+
+    def test_failed_weeks(self):
+        failed_week = self.weeks[2]
+        del self.pages[failed_week]
+        expected = self._get_lessons()
+        with self.assertRaises(lectio.ScheduleRetrievalError) as context:
+            self._get_schedule()
+        self.assertEqual(context.exception.schedule, expected)
+        self.assertEqual(list(context.exception.failed_weeks), [failed_week])
+        lessons = []
+        with self.assertRaises(lectio.ScheduleRetrievalError) as context:
+            for lesson in lectio.iter_schedule(
+                    1, "student", 1, self.N_WEEKS,
+                    session=self._create_session()):
+                lessons.append(lesson)
+        self.assertEqual(lessons, expected)
+        self.assertEqual(context.exception.schedule, [])
+
+if __name__ == "__main__":
+    unittest.main()
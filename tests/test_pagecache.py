@@ -0,0 +1,66 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pickle
+import shutil
+import tempfile
+import unittest
+from lectocal import pagecache
+
+ENTRY = {"digest": "0" * 64, "lessons": list(range(100))}
+
+
+def _get_key(i):
+    return 1, "student", i, "012018"
+
+
+class PageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.entry_size = len(pickle.dumps(ENTRY, pickle.HIGHEST_PROTOCOL))
+
+    def _fill(self, cache, n_entries, first=0):
+        for i in range(first, first + n_entries):
+            cache.put(_get_key(i), ENTRY)
+
+    def _get_cached(self, cache, n_entries):
+        return [i for i in range(n_entries)
+                if cache.get(_get_key(i)) is not None]
+
+    def test_least_recently_used_are_evicted(self):
+        cache = pagecache.PageCache(self.directory, self.entry_size * 3)
+        self._fill(cache, 3)
+        cache.get(_get_key(0))
+        self._fill(cache, 1, 3)
+        self.assertEqual(self._get_cached(cache, 4), [0, 2, 3])
+        self.assertEqual(cache._total_size, self.entry_size * 3)
+
+    def test_replaced_entries_are_counted_once(self):
+        cache = pagecache.PageCache(self.directory, self.entry_size * 3)
+        for n in range(3):
+            self._fill(cache, 3)
+        self.assertEqual(self._get_cached(cache, 3), [0, 1, 2])
+        self.assertEqual(cache._total_size, self.entry_size * 3)
+
+    def test_entries_on_disk_are_counted(self):
+        self._fill(pagecache.PageCache(self.directory), 3)
+        cache = pagecache.PageCache(self.directory, self.entry_size * 3)
+        self._fill(cache, 1, 3)
+        self.assertEqual(self._get_cached(cache, 4), [1, 2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+# Copyright 2016 Philip Hansen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import subprocess
+import sys
+import unittest
+from benchmarks.bench_startup import DEFERRED_MODULES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Cumulative microseconds -X importtime may report for lectocal.run. It
+# takes around 100ms, and importing gcalendar along with it would add
+# another 175ms.
+RUN_IMPORT_BUDGET = 250000
+
+
+def _get_import_times(module):
+    """ Cumulative microseconds taken to import each module, when module
+    is imported in a new interpreter.
+    """
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             "import " + module],
+                            cwd=ROOT,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True,
+                            check=True).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+class ImportTimeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.import_times = _get_import_times("lectocal.run")
+
+    def test_run_imports_within_budget(self):
+        self.assertLess(self.import_times["lectocal.run"], RUN_IMPORT_BUDGET)
+
+    def test_run_defers_google_libraries(self):
+        for module in DEFERRED_MODULES:
+            with self.subTest(module=module):
+                self.assertNotIn(module, self.import_times)
+
+
+if __name__ == "__main__":
+    unittest.main()